@@ -152,27 +152,35 @@ class Gui:
         self.eight_bit = tk.BooleanVar()
         tk.Checkbutton(master, text='8 bit output', variable=self.eight_bit).grid(row=grid_pos + 7, column=1, sticky=tk.W)
 
+        self.defer_eight_bit = tk.BooleanVar()
+        tk.Checkbutton(master, text='Convert to 8 bit after stitching', variable=self.defer_eight_bit). \
+            grid(row=grid_pos + 8, column=1, sticky=tk.W)
+
         self.arrow_overlay = tk.BooleanVar()
         tk.Checkbutton(master, text='Add an arrow overlay that points to the fork', variable=self.arrow_overlay). \
-            grid(row=grid_pos + 8, column=1, sticky=tk.W)
+            grid(row=grid_pos + 9, column=1, sticky=tk.W)
 
         self.contrast_enhance = tk.BooleanVar()
         tk.Checkbutton(master, text='Produce contrast enhanced images', variable=self.contrast_enhance). \
-            grid(row=grid_pos + 9, column=1, sticky=tk.W)
+            grid(row=grid_pos + 10, column=1, sticky=tk.W)
+
+        self.joint_contrast_enhance = tk.BooleanVar()
+        tk.Checkbutton(master, text='Enhance the contrast together with the neighboring tiles (slower)',
+                       variable=self.joint_contrast_enhance).grid(row=grid_pos + 11, column=1, sticky=tk.W)
 
         self.continue_processing = tk.BooleanVar()
         tk.Checkbutton(master, text='Continue processing an experiment', variable=self.continue_processing).\
-            grid(row=grid_pos + 10, column=1, sticky=tk.W)
+            grid(row=grid_pos + 12, column=1, sticky=tk.W)
 
         # Run button
         self.run_button_text = tk.StringVar()
         self.run_button = tk.Button(master, textvariable=self.run_button_text, width=10)
         self.run_button_ready()
-        self.run_button.grid(row=15, column=2, sticky=tk.W, pady=10, padx=10)
+        self.run_button.grid(row=17, column=2, sticky=tk.W, pady=10, padx=10)
 
         # Reset button
         self.reset_button = tk.Button(master, text='Reset Parameters', width=20, command=self.reset_parameters)
-        self.reset_button.grid(row=15, column=0, sticky=tk.E, pady=10, padx=10)
+        self.reset_button.grid(row=17, column=0, sticky=tk.E, pady=10, padx=10)
 
         # Stop button (available during run)
         self.reset_parameters()
@@ -181,6 +189,7 @@ class Gui:
         self.project_path.set('')
         self.max_processes.set(5)
         self.eight_bit.set(True)
+        self.defer_eight_bit.set(False)
         self.batch_size.set(5)
         self.output_folder.set('stitchedForks')
         self.csv_folder_name.set('annotations')
@@ -188,6 +197,7 @@ class Gui:
         self.stitch_threshold.set(1000)
         self.arrow_overlay.set(True)
         self.contrast_enhance.set(True)
+        self.joint_contrast_enhance.set(False)
         self.continue_processing.set(False)
         self.classifier_input.set(False)
         self.csv_path.set('')
@@ -235,6 +245,11 @@ class Gui:
                                            message='You need to enter the correct kind of parameters in all the '
                                                    'required fields and then try again')
 
+    def enhance_contrast_mode(self):
+        if self.joint_contrast_enhance.get():
+            return 'joint'
+        return 'tile'
+
     def run_button_to_running(self):
         self.run_button_text.set('Running...')
         self.run_button.config(height=2, fg='gray', command=self.nothing)
@@ -247,18 +262,26 @@ class Gui:
         # TODO: Catch issues when wrong path is provided or another error/warning occurs in the stitcher => catch my custom Exception, display it to the user
         stitcher = Stitcher(base_path, project_name, self.csv_folder_name.get(), self.output_folder.get())
         stitcher.parse_create_csv_batches(batch_size=self.batch_size.get(), highmag_layer=self.highmag_layer.get())
-        stitcher.manage_batches(self.stitch_threshold.get(), self.eight_bit.get(), show_arrow=self.arrow_overlay.get(),
-                                max_processes=self.max_processes.get(), enhance_contrast=self.contrast_enhance.get())
-        stitcher.combine_csvs(delete_batches=True)
+        stitched_batches = stitcher.manage_batches(self.stitch_threshold.get(), self.eight_bit.get(),
+                                                   show_arrow=self.arrow_overlay.get(),
+                                                   max_processes=self.max_processes.get(),
+                                                   enhance_contrast=self.contrast_enhance.get(),
+                                                   defer_eight_bit=self.defer_eight_bit.get(),
+                                                   enhance_contrast_mode=self.enhance_contrast_mode())
+        stitcher.combine_csvs(delete_batches=True, stitched_batches=stitched_batches)
         logging.info('Finished processing the experiment')
         self.run_button_ready()
 
 
     def continue_run(self, base_path, project_name):
         stitcher = Stitcher(base_path, project_name, self.csv_folder_name.get(), self.output_folder.get())
-        stitcher.manage_batches(self.stitch_threshold.get(), self.eight_bit.get(), show_arrow=self.arrow_overlay.get(),
-                                max_processes=self.max_processes.get(), enhance_contrast=self.contrast_enhance.get())
-        stitcher.combine_csvs(delete_batches=True)
+        stitched_batches = stitcher.manage_batches(self.stitch_threshold.get(), self.eight_bit.get(),
+                                                   show_arrow=self.arrow_overlay.get(),
+                                                   max_processes=self.max_processes.get(),
+                                                   enhance_contrast=self.contrast_enhance.get(),
+                                                   defer_eight_bit=self.defer_eight_bit.get(),
+                                                   enhance_contrast_mode=self.enhance_contrast_mode())
+        stitcher.combine_csvs(delete_batches=True, stitched_batches=stitched_batches)
         logging.info('Finished processing the experiment')
         self.run_button_ready()
 
@@ -266,9 +289,13 @@ class Gui:
         stitcher = Stitcher(base_path, project_name, self.csv_folder_name.get(), self.output_folder.get())
         stitcher.parse_create_classifier_csv_batches(batch_size=self.batch_size.get(), classifier_csv_path=csv_path,
                                                      highmag_layer=self.highmag_layer.get())
-        stitcher.manage_batches(self.stitch_threshold.get(), self.eight_bit.get(), show_arrow=self.arrow_overlay.get(),
-                                max_processes=self.max_processes.get(), enhance_contrast=self.contrast_enhance.get())
-        stitcher.combine_csvs(delete_batches=True)
+        stitched_batches = stitcher.manage_batches(self.stitch_threshold.get(), self.eight_bit.get(),
+                                                   show_arrow=self.arrow_overlay.get(),
+                                                   max_processes=self.max_processes.get(),
+                                                   enhance_contrast=self.contrast_enhance.get(),
+                                                   defer_eight_bit=self.defer_eight_bit.get(),
+                                                   enhance_contrast_mode=self.enhance_contrast_mode())
+        stitcher.combine_csvs(delete_batches=True, stitched_batches=stitched_batches)
         logging.info('Finished processing the experiment')
         self.run_button_ready()
 
@@ -1,7 +1,14 @@
 # Script that parses the Site of Interest annotations from a MAPS XML file
 # Developed with data from MAPS Viewer 3.6
 
-import xml.etree.ElementTree as ET
+# lxml is used if it is available, as it parses considerably faster. The parser only relies on the ElementTree API that
+# both provide, apart from optimizations that are only used with lxml
+try:
+    from lxml import etree as ET
+    _LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _LXML = False
 import csv
 import ast
 import numpy as np
@@ -9,14 +16,168 @@ import pandas as pd
 import math
 from pathlib import Path
 import logging
-import copy
 import multiprocessing
 import unicodedata
 import random
+import functools
+import mmap
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# scipy is optional. Without it, the closest tile of each annotation is found by comparing it to all tiles
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# Fully qualified names of the namespaced tags and attributes that are compared against, defined once
+_XSI_TYPE = '{http://www.w3.org/2001/XMLSchema-instance}type'
+_SAL_NAMESPACE = '{http://schemas.datacontract.org/2004/07/Fei.Applications.SAL}'
+_SAL_X = _SAL_NAMESPACE + 'x'
+_SAL_Y = _SAL_NAMESPACE + 'y'
+_DRAWING_NAMESPACE = '{http://schemas.datacontract.org/2004/07/System.Drawing}'
+_DRAWING_X = _DRAWING_NAMESPACE + 'x'
+_DRAWING_Y = _DRAWING_NAMESPACE + 'y'
+
+# Minimal number of StitchingData.xml files for which they are parsed in separate processes. Fewer files are parsed in
+# threads, as starting the processes takes longer than parsing them
+_MIN_METADATA_FILES_FOR_PROCESSES = 8
+
+# MAPS tile filenames, e.g. 'Tile_001-002-000000_0-000.tif': A 5 character prefix, the 3 digit x & y indices of the
+# tile in the layer, separated by a dash, and a suffix
+_TILE_FILENAME_REGEX = re.compile(r'(.{5})(\d{3})-(\d{3})(.*)', re.DOTALL)
+
+
+@functools.lru_cache(maxsize=None)
+def _local_name(tag):
+    """Returns the tag name of an XML element without its namespace
+
+    Cached, as the files only contain a small set of distinct tags, which are split for every element
+
+    Args:
+        tag (str): Tag of an XML element, e.g. '{namespace}name'
+
+    Returns:
+        str: The tag name without the namespace, e.g. 'name'
+
+    """
+    return tag.rpartition('}')[2]
+
+
+class _StitchingDataTarget:
+    """Parser target that collects the tile information of a StitchingData.xml metadata file
+
+    Used as the target of an lxml XMLParser, such that no element tree is built for the metadata file. Only the folder
+    of the tile images, the filenames and the relative positions of the tiles are kept. close() returns the collected
+    information and resets the target, such that the parser can be reused for the next file.
+
+    Args:
+        position_to_extract (str): Name of the position that is extracted for each tile, either 'UnalignedPosition' or
+            'CalculatedPosition'
+
+    """
+    def __init__(self, position_to_extract):
+        self.position_to_extract = position_to_extract
+        self._reset()
+
+    def _reset(self):
+        self._open_tags = []
+        self._text = []
+        self._tiles = []
+        self._tile_image_folder_path = None
+        self._filenames = []
+        self._relative_positions = []
+
+    def start(self, tag, attrib):
+        tag_name = _local_name(tag)
+        self._open_tags.append(tag_name)
+        self._text = []
+        if tag_name == 'Value':
+            # Filename, x & y position of the tile
+            self._tiles.append([None, math.nan, math.nan])
+
+    def data(self, data):
+        self._text.append(data)
+
+    def end(self, tag):
+        tag_name = self._open_tags.pop()
+        if tag_name == 'TileImageFolder':
+            self._tile_image_folder_path = ''.join(self._text)
+        elif tag_name == 'Value':
+            filename, relative_x, relative_y = self._tiles.pop()
+            if filename is not None:
+                self._filenames.append(filename)
+                self._relative_positions.append((relative_x, relative_y))
+        elif self._tiles:
+            if tag_name == 'ImageFileName' and self._open_tags[-1] == 'Value':
+                self._tiles[-1][0] = ''.join(self._text)
+            elif (tag == _DRAWING_X or tag == _DRAWING_Y) and self._open_tags[-3:] == [
+                    'Value', 'PositioningDetails', self.position_to_extract]:
+                self._tiles[-1][1 if tag == _DRAWING_X else 2] = float(''.join(self._text))
+        self._text = []
+
+    def close(self):
+        result = (self._tile_image_folder_path, self._filenames,
+                  np.array(self._relative_positions, dtype=np.float64).reshape(-1, 2))
+        self._reset()
+        return result
+
+
+def _iter_file_chunks(file_path, chunk_size: int = 1 << 16):
+    """Yields the content of a file in chunks, read through a read-only memory map of the file
+
+    Args:
+        file_path (str): Path to the file
+        chunk_size (int): Number of bytes per chunk
+
+    Yields:
+        bytes: The next chunk of the file
+
+    """
+    with open(file_path, 'rb') as file:
+        try:
+            mapped_file = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return
+        with mapped_file:
+            # The file is parsed from start to end, so the OS can read ahead (where supported)
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mapped_file.madvise(mmap.MADV_SEQUENTIAL)
+            for start in range(0, len(mapped_file), chunk_size):
+                yield mapped_file[start:start + chunk_size]
+
+
+def _parse_stitching_data(metadata_path, position_to_extract):
+    """Parses a StitchingData.xml metadata file of a layer
+
+    Feeds the metadata file to a parser whose target only collects the tile information, instead of building the
+    element tree of the file. Defined on the module level, such that it can be run in a separate process.
+
+    Args:
+        metadata_path (str): Path to the StitchingData.xml file
+        position_to_extract (str): Name of the position that is extracted for each tile, either 'UnalignedPosition' or
+            'CalculatedPosition'
+
+    Returns:
+        tuple: The path to the folder containing the tile images on the microscope computer, a list of the filenames of
+            the tiles and an (N, 2) array of the relative positions of the tiles (RelativeTilePosition_x &
+            RelativeTilePosition_y, NaN if missing) in the same order. None if the metadata file can't be read
+
+    """
+    parser = ET.XMLParser(target=_StitchingDataTarget(position_to_extract))
+    try:
+        for chunk in _iter_file_chunks(metadata_path):
+            parser.feed(chunk)
+    except OSError:
+        return None
+    return parser.close()
 
 
 class XmlParsingFailed(Exception):
     def __init__(self, message):
+        super().__init__(message)
         logging.error(message)
 
 
@@ -54,11 +215,10 @@ class MapsXmlParser:
             of the whole layer (its width in meters, totalHfw), the name of the layer (layer_name), the vertical field
             width of each tile (its width in meters, tileVfw), and the global stage position of the corner of the layer
             (in meters, StagePosition_corner_x & StagePosition_corner_y)
-        tiles (dict): Contains information about individual tiles. The keys are the combined layer name & filename of
-            the tile and the values are a dictionary again. Each tile contains the information about what layer it
-            belongs to (layer, key to the layer dict), the path to the image as a Path variable (img_path), its
-            filename, the name of the layer (layer_name) and its relative position x & y within that layer
-            (RelativeTilePosition_x & RelativeTilePosition_y)
+        tiles (dict): Index of the individual tiles. The keys are the combined layer name & filename of the tile and
+            the values are tuples of the key of the layer it belongs to (key to the layer dict) and the index of the tile
+            within that layer. The information about a tile is stored per layer and can be accessed as a dictionary
+            with get_tile_info
         annotations (dict): Contains the information about all the annotations. The keys are the names of the
             annotations (MAPS enforces uniqueness), its values are a dictionary containing the StagePosition_x &
             StagePosition_y positions of the annotation (in m => global coordinate system for the experiment)
@@ -96,10 +256,20 @@ class MapsXmlParser:
         # Internal variables
         self._name_of_highmag_layer = name_of_highmag_layer
         xml_file_name = 'MapsProject.xml'
-        xml_file_path = self.project_folder_path / xml_file_name
-        self._xml_file = self.load_xml(xml_file_path)
+        self._xml_file_path = self.project_folder_path / xml_file_name
+        if not self._xml_file_path.is_file():
+            raise XmlParsingFailed("Can't find the MAPS XML File at the location {}".format(self._xml_file_path))
         self._tile_names = []
-        self._tile_center_stage_positions = []
+        self._tile_center_stage_positions = np.empty((0, 2))
+        self._layer_tile_filenames = {}
+        self._layer_relative_positions = {}
+        self._layer_img_paths = {}
+        self._tile_tree = None
+        self._layer_stepsizes = {}
+        # Offsets (i, j) of the tiles surrounding a center tile in the stitch_radius, in the order of the
+        # surrounding_tile_names
+        self._surrounding_offsets = [(i, j) for i in range(-stitch_radius, stitch_radius + 1)
+                                     for j in range(-stitch_radius, stitch_radius + 1)]
 
         if use_unregistered_pos:
             self._position_to_extract = 'UnalignedPosition'
@@ -107,21 +277,46 @@ class MapsXmlParser:
             self._position_to_extract = 'CalculatedPosition'
 
     @staticmethod
-    def load_xml(xml_file_path):
-        """Loads and returns the MAPS XML File
+    def iter_layer_groups(xml_file_path):
+        """Streams through the MAPS XML File and yields its top level LayerGroups
+
+        The XML file is not loaded as a whole. Each LayerGroup is yielded once it has been parsed completely and is
+        cleared afterwards, together with the already processed elements before it, to keep the memory usage low.
 
         Args:
             xml_file_path (Path): Path to the XML file as a pathlib path
 
-        Returns:
-            root: The root of the XML file parsed with xml.etree.ElementTree
+        Yields:
+            element: The lxml.etree element of a LayerGroup
 
         """
+        # lxml raises an OSError (not a FileNotFoundError) if it can't read the file
         try:
-            root = ET.parse(xml_file_path).getroot()
-        except FileNotFoundError:
+            if _LXML:
+                # lxml only reports the LayerGroup elements and can remove the processed elements from the tree
+                for _, layer_group in ET.iterparse(str(xml_file_path), events=('end', ), tag='{*}LayerGroup',
+                                                   remove_blank_text=True, huge_tree=True):
+                    parent = layer_group.getparent()
+                    # Nested LayerGroups are processed as part of their top level LayerGroup
+                    if parent is None or _local_name(parent.tag) != 'LayerGroups':
+                        continue
+                    yield layer_group
+                    layer_group.clear()
+                    while layer_group.getprevious() is not None:
+                        del parent[0]
+            else:
+                # ElementTree elements don't know their parent, so the open elements are tracked
+                open_tags = []
+                for event, element in ET.iterparse(str(xml_file_path), events=('start', 'end')):
+                    if event == 'start':
+                        open_tags.append(_local_name(element.tag))
+                        continue
+                    open_tags.pop()
+                    if open_tags and open_tags[-1] == 'LayerGroups' and _local_name(element.tag) == 'LayerGroup':
+                        yield element
+                        element.clear()
+        except OSError:
             raise XmlParsingFailed("Can't find the MAPS XML File at the location {}".format(xml_file_path))
-        return root
 
     def parse_xml(self):
         """Run function for the class
@@ -142,11 +337,12 @@ class MapsXmlParser:
         return self.annotation_tiles
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def convert_windows_pathstring_to_path_object(string_path):
         """Converts a windows path string to a path object
 
         Some paths are provided in the XML file and the metadata as Windows paths. This function creates pathlib Path
-        objects out of them.
+        objects out of them. The results are cached, as the same paths are converted repeatedly.
 
         Args:
             string_path (str): String of a Windows path containing double backslashes
@@ -155,11 +351,7 @@ class MapsXmlParser:
             path: Path object of the string_path
 
         """
-        folders = string_path.split('\\')
-        path = Path()
-        for folder in folders:
-            path = path / folder
-        return path
+        return Path(*string_path.split('\\'))
 
     def convert_img_path_to_local_path(self, img_path):
         """Converts a local path of the microscope computer to a path of the image in the project folder
@@ -177,15 +369,12 @@ class MapsXmlParser:
 
         """
         folders = img_path.split('\\')
-        path = self.project_folder_path
         try:
             layersdata_index = folders.index('LayersData')
         except ValueError:
             raise XmlParsingFailed('Could not find the folder LayersData that should contain the raw data in the '
                                    'filepath for the iamge_files: {}'.format(img_path))
-        for folder in folders[layersdata_index:]:
-            path = path / folder
-        return path
+        return self.project_folder_path.joinpath(*folders[layersdata_index:])
 
     @staticmethod
     def create_logger(log_file_path, multiprocessing_logger: bool = False):
@@ -243,11 +432,8 @@ class MapsXmlParser:
 
         """
         # Extract the information about all the layers (high magnification acquisition layers)
-        for xml_category in self._xml_file:
-            if xml_category.tag.endswith('LayerGroups'):
-                for sub_category in xml_category:
-                    if sub_category.tag.endswith('LayerGroup'):
-                        self._process_layer_group(sub_category)
+        for layer_group in self.iter_layer_groups(self._xml_file_path):
+            self._process_layer_group(layer_group)
 
         # If the parsing did not find any tiles, raise an error
         if not self.layers:
@@ -274,124 +460,135 @@ class MapsXmlParser:
         """
         log_file_path = str(self.project_folder_path / (self.project_folder_path.name + '.log'))
         logger = self.create_logger(log_file_path)
-        for ggc in layer_group:
+
+        # Find the name and the Layers of the LayerGroup with element paths, then process each Layer once. The search
+        # for the name stops at the first displayName of the LayerGroup
+        is_highmag_group = layer_group.findtext('{*}displayName') == self._name_of_highmag_layer
+        if is_highmag_group:
             # Get the path to the metadata xml files for all the highmag layers,
             # the pixel size and the StagePosition of the layers
-            if ggc.tag.endswith('displayName') and ggc.text == self._name_of_highmag_layer:
-                logger.info('Extracting images from {} layers'.format(ggc.text))
-
-                for highmag in layer_group:
-                    if highmag.tag.endswith('Layers'):
-                        for layer in highmag:
-                            # Check if this layers is a TileLayer or any other kind of layers.
-                            # Only proceed to process TileLayers
-                            layer_type = layer.attrib['{http://www.w3.org/2001/XMLSchema-instance}type']
-                            if layer_type == 'TileLayer':
-                                self._process_tile_layer(layer)
-                            elif layer_type == 'LayerGroup':
-                                # If there are nested LayerGroups, recursively call the function again
-                                # with this LayerGroup
-                                self._process_layer_group(layer)
-                            elif layer_type == 'AnnotationLayer':
-                                self._extract_annotation_locations(layer)
-                            else:
-                                logger.warning('XML Parser does not know how to deal with {} Layers and '
-                                               'therefore does not parse them'.format(layer_type))
-            else:
-                if ggc.tag.endswith('Layers'):
-                    for layer in ggc:
-                        layer_type = layer.attrib['{http://www.w3.org/2001/XMLSchema-instance}type']
-                        if layer_type == 'AnnotationLayer':
-                            self._extract_annotation_locations(layer)
-                        elif layer_type == 'LayerGroup':
-                            # If there are nested LayerGroups, recursively call the function again
-                            # with this LayerGroup
-                            self._process_layer_group(layer)
+            logger.info('Extracting images from {} layers'.format(self._name_of_highmag_layer))
+
+        for layer in layer_group.iterfind('{*}Layers/*'):
+            # Check if this layers is a TileLayer or any other kind of layers.
+            # Only proceed to process TileLayers of the highmag LayerGroup
+            layer_type = layer.attrib[_XSI_TYPE]
+            if layer_type == 'AnnotationLayer':
+                self._extract_annotation_locations(layer)
+            elif layer_type == 'LayerGroup':
+                # If there are nested LayerGroups, recursively call the function again
+                # with this LayerGroup
+                self._process_layer_group(layer)
+            elif is_highmag_group:
+                if layer_type == 'TileLayer':
+                    self._process_tile_layer(layer)
+                else:
+                    logger.warning('XML Parser does not know how to deal with {} Layers and '
+                                   'therefore does not parse them'.format(layer_type))
 
     def _process_tile_layer(self, layer):
         """Extracts all necessary information of a highmag Tile Layer and saves it to self.layers
 
+        Each child of the layer is dispatched to its handler in _TILE_LAYER_HANDLERS based on its tag name, instead of
+        comparing it to every tag name in turn. The handler of each fully qualified tag is looked up once and cached
+        in _tile_layer_tag_handlers, such that each child only needs a single dictionary lookup.
+
         Args:
             layer: Part of the XML object that contains the information for a TileLayer
 
         """
-        layer_type = layer.attrib['{http://www.w3.org/2001/XMLSchema-instance}type']
+        layer_type = layer.attrib[_XSI_TYPE]
         assert (layer_type == 'TileLayer')
-        for layer_content in layer:
-            if layer_content.tag.endswith('metaDataLocation'):
-                metadata_location = layer_content.text
-                self.layers[metadata_location] = {}
-        try:
-            for layer_content in layer:
-                if layer_content.tag.endswith('totalHfw'):
-                    # noinspection PyUnboundLocalVariable
-                    self.layers[metadata_location]['totalHfw'] = float(list(layer_content.attrib.values())[1])
-
-                if layer_content.tag.endswith('tileHfw'):
-                    # noinspection PyUnboundLocalVariable
-                    self.layers[metadata_location]['tileHfw'] = float(list(layer_content.attrib.values())[1])
-
-                if layer_content.tag.endswith('overlapHorizontal'):
-                    # noinspection PyUnboundLocalVariable
-                    self.layers[metadata_location]['overlapHorizontal'] = float(layer_content[0].text) / 100.
-                if layer_content.tag.endswith('overlapVertical'):
-                    # noinspection PyUnboundLocalVariable
-                    self.layers[metadata_location]['overlapVertical'] = float(layer_content[0].text) / 100.
-
-                if layer_content.tag.endswith('rotation'):
-                    # noinspection PyUnboundLocalVariable
-                    self.layers[metadata_location]['rotation'] = float(list(layer_content.attrib.values())[1])
-
-                if layer_content.tag.endswith('rows'):
-                    # noinspection PyUnboundLocalVariable
-                    self.layers[metadata_location]['rows'] = int(layer_content.text)
-
-                if layer_content.tag.endswith('columns'):
-                    # noinspection PyUnboundLocalVariable
-                    self.layers[metadata_location]['columns'] = int(layer_content.text)
-
-                if layer_content.tag.endswith('scanResolution'):
-                    for scanres_info in layer_content:
-                        if scanres_info.tag.endswith('height'):
-                            height = int(scanres_info.text)
-                            if self.img_height == height or self.img_height == 0:
-                                self.img_height = height
-                            else:
-                                raise Exception(
-                                    'Image height needs to be constant for the whole {} layer. It was {} before and '
-                                    'is {} in the current layer'.format(self._name_of_highmag_layer,
-                                                                        self.img_height, height))
-                        if scanres_info.tag.endswith('width'):
-                            width = int(scanres_info.text)
-                            if self.img_width == width or self.img_width == 0:
-                                self.img_width = width
-                            else:
-                                raise Exception(
-                                    'Image width needs to be constant for the whole {} layer. It was {} before and '
-                                    'is {} in the current layer'.format(self._name_of_highmag_layer,
-                                                                        self.img_width, width))
-
-                if layer_content.tag.endswith('pixelSize'):
-                    pixel_size = float(layer_content.attrib['Value'])
-                    if self.pixel_size == pixel_size or self.pixel_size == 0:
-                        self.pixel_size = pixel_size
-                    else:
-                        raise Exception('Pixel size needs to be constant for the whole {} layer. It was {} before and '
-                                        'is {} in the current layer'.format(self._name_of_highmag_layer,
-                                                                            self.pixel_size, pixel_size))
-
-                if layer_content.tag.endswith('StagePosition'):
-                    for positon_info in layer_content:
-                        if positon_info.tag == '{http://schemas.datacontract.org/2004/07/Fei.Applications.SAL}x':
-                            # noinspection PyUnboundLocalVariable
-                            self.layers[metadata_location][
-                                'StagePosition_center_x'] = float(positon_info.text)
-                        elif positon_info.tag == '{http://schemas.datacontract.org/2004/07/Fei.Applications.SAL}y':
-                            # noinspection PyUnboundLocalVariable
-                            self.layers[metadata_location][
-                                'StagePosition_center_y'] = float(positon_info.text)
-        except NameError:
+        metadata_location = layer.findtext('{*}metaDataLocation')
+        if metadata_location is None:
             raise XmlParsingFailed("Can't find the metaDataLocation in the MAPS XML File")
+        layer_metadata = self.layers[metadata_location] = {}
+
+        tag_handlers = self._tile_layer_tag_handlers
+        for layer_content in layer:
+            try:
+                handler = tag_handlers[layer_content.tag]
+            except KeyError:
+                handler = tag_handlers[layer_content.tag] = self._TILE_LAYER_HANDLERS.get(
+                    _local_name(layer_content.tag))
+            if handler is not None:
+                handler(self, layer_content, layer_metadata)
+
+    def _parse_total_hfw(self, layer_content, layer_metadata):
+        layer_metadata['totalHfw'] = float(layer_content.attrib['Value'])
+
+    def _parse_tile_hfw(self, layer_content, layer_metadata):
+        layer_metadata['tileHfw'] = float(layer_content.attrib['Value'])
+
+    def _parse_overlap_horizontal(self, layer_content, layer_metadata):
+        layer_metadata['overlapHorizontal'] = float(layer_content[0].text) / 100.
+
+    def _parse_overlap_vertical(self, layer_content, layer_metadata):
+        layer_metadata['overlapVertical'] = float(layer_content[0].text) / 100.
+
+    def _parse_rotation(self, layer_content, layer_metadata):
+        layer_metadata['rotation'] = float(layer_content.attrib['Value'])
+
+    def _parse_rows(self, layer_content, layer_metadata):
+        layer_metadata['rows'] = int(layer_content.text)
+
+    def _parse_columns(self, layer_content, layer_metadata):
+        layer_metadata['columns'] = int(layer_content.text)
+
+    def _parse_scan_resolution(self, layer_content, layer_metadata):
+        for scanres_info in layer_content:
+            scanres_tag = _local_name(scanres_info.tag)
+            if scanres_tag == 'height':
+                height = int(scanres_info.text)
+                if self.img_height == height or self.img_height == 0:
+                    self.img_height = height
+                else:
+                    raise XmlParsingFailed(
+                        'Image height needs to be constant for the whole {} layer. It was {} before and '
+                        'is {} in the current layer'.format(self._name_of_highmag_layer,
+                                                            self.img_height, height))
+            elif scanres_tag == 'width':
+                width = int(scanres_info.text)
+                if self.img_width == width or self.img_width == 0:
+                    self.img_width = width
+                else:
+                    raise XmlParsingFailed(
+                        'Image width needs to be constant for the whole {} layer. It was {} before and '
+                        'is {} in the current layer'.format(self._name_of_highmag_layer,
+                                                            self.img_width, width))
+
+    def _parse_pixel_size(self, layer_content, layer_metadata):
+        pixel_size = float(layer_content.attrib['Value'])
+        if self.pixel_size == pixel_size or self.pixel_size == 0:
+            self.pixel_size = pixel_size
+        else:
+            raise XmlParsingFailed('Pixel size needs to be constant for the whole {} layer. It was {} before and '
+                                   'is {} in the current layer'.format(self._name_of_highmag_layer,
+                                                                       self.pixel_size, pixel_size))
+
+    def _parse_layer_stage_position(self, layer_content, layer_metadata):
+        for positon_info in layer_content:
+            if positon_info.tag == _SAL_X:
+                layer_metadata['StagePosition_center_x'] = float(positon_info.text)
+            elif positon_info.tag == _SAL_Y:
+                layer_metadata['StagePosition_center_y'] = float(positon_info.text)
+
+    # Handlers for the children of a TileLayer, by tag name (without namespace). Each handler is called with the
+    # parser, the XML element and the dictionary of the layer in self.layers
+    _TILE_LAYER_HANDLERS = {
+        'totalHfw': _parse_total_hfw,
+        'tileHfw': _parse_tile_hfw,
+        'overlapHorizontal': _parse_overlap_horizontal,
+        'overlapVertical': _parse_overlap_vertical,
+        'rotation': _parse_rotation,
+        'rows': _parse_rows,
+        'columns': _parse_columns,
+        'scanResolution': _parse_scan_resolution,
+        'pixelSize': _parse_pixel_size,
+        'StagePosition': _parse_layer_stage_position,
+    }
+    # The handlers (or None) by fully qualified tag, filled by _process_tile_layer with the tags it encounters
+    _tile_layer_tag_handlers = {}
 
     def _extract_annotation_locations(self, annotation_layer):
         """Extract annotation metadata from the XML file and saves them to the self.annotations dictionary
@@ -403,105 +600,111 @@ class MapsXmlParser:
         experiment)
 
         """
-        for potential_annotation_content in annotation_layer:
-            # Only check Sites Of Interest, not Area of Interest. Both are Annotation Layers, but Areas of Interest
-            # have the isArea value as true
-            if potential_annotation_content.tag.endswith('isArea') and potential_annotation_content.text == 'false':
-                for annotation_content in annotation_layer:
-                    if annotation_content.tag.endswith('RealDisplayName'):
-                        annotation_name = self.create_valid_name(annotation_content.text)
-                        self.annotations[annotation_name] = {}
-                try:
-                    for annotation_content in annotation_layer:
-                        if annotation_content.tag.endswith('StagePosition'):
-                            for a in annotation_content:
-                                if a.tag == '{http://schemas.datacontract.org/2004/07/Fei.Applications.SAL}x':
-                                    # noinspection PyUnboundLocalVariable
-                                    self.annotations[annotation_name]['StagePosition_x'] = float(a.text)
-                                elif a.tag == '{http://schemas.datacontract.org/2004/07/Fei.Applications.SAL}y':
-                                    # noinspection PyUnboundLocalVariable
-                                    self.annotations[annotation_name]['StagePosition_y'] = float(a.text)
-                except NameError:
-                    raise XmlParsingFailed("Can't find the Annotations Names in the MAPS XML File")
+        # Only check Sites Of Interest, not Area of Interest. Both are Annotation Layers, but Areas of Interest
+        # have the isArea value as true
+        if annotation_layer.findtext('{*}isArea') != 'false':
+            return
+
+        annotation_name = annotation_layer.findtext('{*}RealDisplayName')
+        if annotation_name is None:
+            raise XmlParsingFailed("Can't find the Annotations Names in the MAPS XML File")
+
+        stage_position = {}
+        for a in annotation_layer.iterfind('{*}StagePosition/*'):
+            if a.tag == _SAL_X:
+                stage_position['StagePosition_x'] = float(a.text)
+            elif a.tag == _SAL_Y:
+                stage_position['StagePosition_y'] = float(a.text)
+        self.annotations[self.create_valid_name(annotation_name)] = stage_position
 
     def get_relative_tile_locations(self):
         """Read in all the metadata files for the different layers to get the relative tile positions
 
         Each layer has its own metadata XML file that contains the relative positions of all the tiles in the layer.
-        This function goes through all of them, extracts the information and saves it to the tiles dictionary.
-        The keys are the combined layer name & filename of the tile and the values are a dictionary again. Each tile
-        contains the information about what layer it belongs to (layer, key to the layer dict), the path to the image as
-        a Path variable (img_path), its filename, the name of the layer (layer_name) and its relative position x & y
-        within that layer (RelativeTilePosition_x & RelativeTilePosition_y)
+        This function goes through all of them and extracts the filenames, the relative positions x & y within the layer
+        (RelativeTilePosition_x & RelativeTilePosition_y) and the path to the images of the tiles. They are stored per
+        layer. The tiles dictionary maps the combined layer name & filename of each tile to its layer and its index
+        within the layer, get_tile_info returns the information of a tile as a dictionary.
+        The metadata files are independent of each other, so if there are multiple layers, they are parsed in parallel
+        processes.
 
         """
         metadata_filename = 'StitchingData.xml'
-        for metadata_location in self.layers:
-            tile_image_folder_path = ''
-            metadata_path = self.project_folder_path.joinpath(
-                self.convert_windows_pathstring_to_path_object(metadata_location)) / metadata_filename
-            try:
-                metadata_root = ET.parse(metadata_path).getroot()
-            except FileNotFoundError:
+        metadata_locations = list(self.layers)
+        metadata_paths = [str(self.project_folder_path.joinpath(
+            self.convert_windows_pathstring_to_path_object(metadata_location)) / metadata_filename)
+            for metadata_location in metadata_locations]
+
+        parse_metadata = functools.partial(_parse_stitching_data, position_to_extract=self._position_to_extract)
+        if len(metadata_paths) >= _MIN_METADATA_FILES_FOR_PROCESSES:
+            # Send the metadata files to the processes in chunks (about 4 chunks per process), such that projects with
+            # many small layers don't spend their time on the communication between the processes
+            max_workers = min(len(metadata_paths), os.cpu_count() or 1)
+            chunksize = max(1, len(metadata_paths) // (4 * max_workers))
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                parsed_metadata = list(executor.map(parse_metadata, metadata_paths, chunksize=chunksize))
+        elif len(metadata_paths) > 1:
+            # Threads still overlap reading the files, e.g. from a network share
+            with ThreadPoolExecutor(max_workers=len(metadata_paths)) as executor:
+                parsed_metadata = list(executor.map(parse_metadata, metadata_paths))
+        else:
+            parsed_metadata = [parse_metadata(metadata_path) for metadata_path in metadata_paths]
+
+        for metadata_location, metadata_path, layer_metadata in zip(metadata_locations, metadata_paths,
+                                                                    parsed_metadata):
+            if layer_metadata is None:
                 log_file_path = str(self.project_folder_path / (self.project_folder_path.name + '.log'))
                 logger = self.create_logger(log_file_path)
-                logger.warn('Could not find the Metadata file for layer {}. Skipping it. If this layer contained ' +
-                            'annotations, those cannot be stitched afterwards.'.format(metadata_path))
+                logger.warning('Could not find the Metadata file for layer {}. Skipping it. If this layer contained '
+                               'annotations, those cannot be stitched afterwards.'.format(metadata_path))
                 continue
 
-            for metadata_child in metadata_root:
-                if metadata_child.tag.endswith('tileSet'):
-                    for metadata_grandchild in metadata_child:
-                        if metadata_grandchild.tag.endswith('TileImageFolder'):
-                            tile_image_folder_path = metadata_grandchild.text
-                            current_layer = tile_image_folder_path.split('\\')[-1]
-                            self.layers[metadata_location]['layer_name'] = current_layer
-
-                        if metadata_grandchild.tag.endswith('_tileCollection'):
-                            for ggc in metadata_grandchild:
-                                if ggc.tag.endswith('_innerCollection'):
-                                    for gggc in ggc:
-                                        for keyvalue in gggc:
-                                            if keyvalue.tag.endswith('Value'):
-                                                for value in keyvalue:
-                                                    if value.tag.endswith('ImageFileName'):
-                                                        # noinspection PyUnboundLocalVariable
-                                                        tile_name = current_layer + '_' + value.text
-                                                        self.tiles[tile_name] = {'layers': metadata_location,
-                                                                                 'img_path': self.convert_img_path_to_local_path(
-                                                                                     tile_image_folder_path),
-                                                                                 'filename': value.text,
-                                                                                 'layer_name': current_layer}
-
-                                                for value in keyvalue:
-                                                    if value.tag.endswith('PositioningDetails'):
-                                                        for positioning_detail in value:
-                                                            if positioning_detail.tag.endswith(
-                                                                    self._position_to_extract):
-                                                                for position in positioning_detail:
-
-                                                                    if position.tag == '{http://schemas.datacontract.' \
-                                                                                       'org/2004/07/System.Drawing}x':
-                                                                        # noinspection PyUnboundLocalVariable
-                                                                        self.tiles[tile_name][
-                                                                            'RelativeTilePosition_x'] = float(
-                                                                            position.text)
-                                                                    elif position.tag == '{http://schemas.' \
-                                                                                         'datacontract.org/2004/07/' \
-                                                                                         'System.Drawing}y':
-                                                                        # noinspection PyUnboundLocalVariable
-                                                                        self.tiles[tile_name][
-                                                                            'RelativeTilePosition_y'] = float(
-                                                                            position.text)
+            # The filenames & relative positions of the tiles are kept per layer as a list and an array, the
+            # information that is the same for all tiles of a layer only once. self.tiles only indexes into them
+            tile_image_folder_path, filenames, relative_positions = layer_metadata
+            current_layer = tile_image_folder_path.split('\\')[-1]
+            self.layers[metadata_location]['layer_name'] = current_layer
+            self._layer_tile_filenames[metadata_location] = filenames
+            self._layer_relative_positions[metadata_location] = relative_positions
+            if filenames:
+                self._layer_img_paths[metadata_location] = self.convert_img_path_to_local_path(tile_image_folder_path)
+            for tile_index, filename in enumerate(filenames):
+                self.tiles[current_layer + '_' + filename] = (metadata_location, tile_index)
+
+    def get_tile_info(self, tile_name):
+        """Returns the information about a tile as a dictionary
+
+        Args:
+            tile_name (str): The combined layer name & filename of the tile, a key of self.tiles
+
+        Returns:
+            dict: The information about what layer the tile belongs to (layers, key to the layer dict), the path to the
+                image as a Path variable (img_path), its filename, the name of the layer (layer_name) and its relative
+                position x & y within that layer (RelativeTilePosition_x & RelativeTilePosition_y)
+
+        """
+        layer, tile_index = self.tiles[tile_name]
+        relative_x, relative_y = self._layer_relative_positions[layer][tile_index].tolist()
+        return {'layers': layer,
+                'img_path': self._layer_img_paths[layer],
+                'filename': self._layer_tile_filenames[layer][tile_index],
+                'layer_name': self.layers[layer]['layer_name'],
+                'RelativeTilePosition_x': relative_x,
+                'RelativeTilePosition_y': relative_y}
 
     def calculate_absolute_tile_coordinates(self):
         """Calculate the absolute stage positions of all tiles based on their relative positions
 
         Calculate the absolute stage position of the center of each tile based on the relative tile positions, the
         rotation of the layer and the absolute stage position of the center of the layer. The resulting position is
-        saved to the _tile_center_stage_positions and the corresponding tile name to the _tile_names list.
+        saved to the _tile_center_stage_positions array and the corresponding tile name to the _tile_names list.
 
         """
+        # The array of the tile center positions is allocated once and filled layer by layer
+        n_tiles = sum(len(filenames) for filenames in self._layer_tile_filenames.values())
+        self._tile_center_stage_positions = np.empty((n_tiles, 2))
+        self._tile_names = []
+
         for current_layer_key in self.layers:
             current_layer = self.layers[current_layer_key]
 
@@ -513,38 +716,45 @@ class MapsXmlParser:
             vertical_field_width = (current_layer['rows'] - 1) * current_layer['tileVfw'] * (
                     1 - current_layer['overlapHorizontal']) + current_layer['tileVfw']
 
-            relative_0_x = current_layer['StagePosition_center_x'] - math.sin(
-                current_layer['rotation'] / 180 * math.pi) * vertical_field_width / 2 + math.cos(
-                current_layer['rotation'] / 180 * math.pi) * horizontal_field_width / 2
-            relative_0_y = current_layer['StagePosition_center_y'] - math.cos(
-                current_layer['rotation'] / 180 * math.pi) * vertical_field_width / 2 - math.sin(
-                current_layer['rotation'] / 180 * math.pi) * horizontal_field_width / 2
-            relative_0 = np.array([relative_0_x, relative_0_y])
-
-            self.layers[current_layer_key]['StagePosition_corner_x'] = relative_0[0]
-            self.layers[current_layer_key]['StagePosition_corner_y'] = relative_0[1]
-
-            for current_tile_name in self.tiles:
-                current_tile = self.tiles[current_tile_name]
-                if current_tile['layers'] == current_layer_key:
-                    relative_x_stepsize = np.array([self.pixel_size * math.cos(current_layer['rotation']
-                                                                               / 180 * math.pi),
-                                                    self.pixel_size * math.sin(current_layer['rotation']
-                                                                               / 180 * math.pi)])
-                    relative_y_stepsize = np.array([self.pixel_size * math.sin(current_layer['rotation']
-                                                                               / 180 * math.pi),
-                                                    self.pixel_size * math.cos(current_layer['rotation']
-                                                                               / 180 * math.pi)])
-
-                    # absolute_tile_pos is the position of the corner of the tile in absolute Stage Position
-                    # coordinates, the tile_center_stage_position are the Stage Position coordinates of the tile
-                    absolute_tile_pos = relative_0 + current_tile['RelativeTilePosition_x'] * relative_x_stepsize \
-                                        + current_tile['RelativeTilePosition_y'] * relative_y_stepsize
-                    tile_center_stage_position = absolute_tile_pos + self.img_width / 2 * relative_x_stepsize \
-                                                 + self.img_height / 2 * relative_y_stepsize
-
-                    self._tile_center_stage_positions.append(tile_center_stage_position)
-                    self._tile_names.append([current_layer['layer_name'], current_tile_name])
+            # The trigonometric functions of the rotation are only calculated once per layer
+            rotation = math.radians(current_layer['rotation'])
+            cos_rotation = math.cos(rotation)
+            sin_rotation = math.sin(rotation)
+
+            relative_0_x = current_layer['StagePosition_center_x'] - sin_rotation * vertical_field_width / 2 \
+                + cos_rotation * horizontal_field_width / 2
+            relative_0_y = current_layer['StagePosition_center_y'] - cos_rotation * vertical_field_width / 2 \
+                - sin_rotation * horizontal_field_width / 2
+
+            self.layers[current_layer_key]['StagePosition_corner_x'] = relative_0_x
+            self.layers[current_layer_key]['StagePosition_corner_y'] = relative_0_y
+
+            # The rows are the stage position steps of one pixel in x & y direction of the tile. They are kept for the
+            # calculation of the annotation position within its tile
+            stepsizes = self.pixel_size * np.array([[cos_rotation, sin_rotation],
+                                                    [sin_rotation, cos_rotation]])
+            self._layer_stepsizes[current_layer_key] = stepsizes
+
+            layer_filenames = self._layer_tile_filenames.get(current_layer_key, [])
+            if not layer_filenames:
+                continue
+
+            # The tile_center_stage_positions are the Stage Position coordinates of the center of the tiles: The
+            # corner of the tile in absolute Stage Position coordinates plus half of the image in each direction.
+            # Calculated for all tiles of the layer at once
+            relative_centers = self._layer_relative_positions[current_layer_key] + [self.img_width / 2,
+                                                                                    self.img_height / 2]
+            first_tile_index = len(self._tile_names)
+            self._tile_center_stage_positions[first_tile_index:first_tile_index + len(layer_filenames)] = \
+                relative_centers @ stepsizes + (relative_0_x, relative_0_y)
+            self._tile_names.extend([current_layer['layer_name'], current_layer['layer_name'] + '_' + filename]
+                                    for filename in layer_filenames)
+
+        # Build the spatial index of the tile centers once, for the search of the closest tile of each annotation
+        if cKDTree is not None and n_tiles > 0:
+            self._tile_tree = cKDTree(self._tile_center_stage_positions)
+        else:
+            self._tile_tree = None
 
     # noinspection PyTypeChecker
     def find_annotation_tile(self):
@@ -570,56 +780,68 @@ class MapsXmlParser:
         distance_threshold = np.square(self.img_height / 2 * self.pixel_size) \
                              + np.square(self.img_width / 2 * self.pixel_size)
 
-        for annotation_name in self.annotations:
-            a_coordinates = np.array([self.annotations[annotation_name]['StagePosition_x'],
-                                      self.annotations[annotation_name]['StagePosition_y']])
-            distance_map = np.square(np.array(self._tile_center_stage_positions) - a_coordinates)
-            quadratic_distance = distance_map[:, 0] + distance_map[:, 1]
-            tile_index = np.argmin(quadratic_distance)
-            current_tile = self.tiles[self._tile_names[tile_index][1]]
-
-            if quadratic_distance[tile_index] < distance_threshold:
-                self.annotation_tiles[annotation_name] = copy.deepcopy(current_tile)
-                self.annotation_tiles[annotation_name]['pixel_size'] = self.pixel_size
-                self.annotation_tiles[annotation_name]['Annotation_StagePosition_x'] = \
-                    self.annotations[annotation_name]['StagePosition_x']
-                self.annotation_tiles[annotation_name]['Annotation_StagePosition_y'] = \
-                    self.annotations[annotation_name]['StagePosition_y']
+        # Find the closest tile for all annotations at once
+        tile_center_stage_positions = self._tile_center_stage_positions
+        annotation_coordinates = np.array([[annotation['StagePosition_x'], annotation['StagePosition_y']]
+                                           for annotation in self.annotations.values()]).reshape(-1, 2)
+        if self._tile_tree is not None and len(tile_center_stage_positions) > 1:
+            # Query the two closest tiles. If an annotation is equally far from both, use the tile that comes first,
+            # like the search without scipy does
+            distances, closest_tile_indices = self._tile_tree.query(annotation_coordinates, k=2)
+            is_tie = distances[:, 0] == distances[:, 1]
+            tile_indices = np.where(is_tie, closest_tile_indices.min(axis=1), closest_tile_indices[:, 0])
+            quadratic_distances = np.square(distances[:, 0])
+        else:
+            # Calculate the distance matrix for blocks of annotations at once. The block size limits the distance
+            # matrix to about a million entries
+            tile_indices = np.empty(len(annotation_coordinates), dtype=np.intp)
+            quadratic_distances = np.empty(len(annotation_coordinates))
+            block_size = max(1, 2 ** 20 // max(1, len(tile_center_stage_positions)))
+            for block_start in range(0, len(annotation_coordinates), block_size):
+                block = slice(block_start, block_start + block_size)
+                # Square & sum the x & y differences in one step, without an intermediate squared distance map
+                differences = annotation_coordinates[block, np.newaxis, :] - tile_center_stage_positions
+                quadratic_distance = np.einsum('ijk,ijk->ij', differences, differences)
+                tile_indices[block] = np.argmin(quadratic_distance, axis=1)
+                quadratic_distances[block] = quadratic_distance[np.arange(len(quadratic_distance)),
+                                                                tile_indices[block]]
+
+        inverse_stepsizes = {}
+        for (annotation_name, annotation), a_coordinates, tile_index, quadratic_distance in zip(
+                self.annotations.items(), annotation_coordinates, tile_indices, quadratic_distances):
+            if quadratic_distance < distance_threshold:
+                annotation_tile = self.get_tile_info(self._tile_names[tile_index][1])
+                self.annotation_tiles[annotation_name] = annotation_tile
+                annotation_tile['pixel_size'] = self.pixel_size
+                annotation_tile['Annotation_StagePosition_x'] = annotation['StagePosition_x']
+                annotation_tile['Annotation_StagePosition_y'] = annotation['StagePosition_y']
                 # Calculate the position of the fork within the image
-                distance_to_center = (np.array(self._tile_center_stage_positions[tile_index]) - a_coordinates)
+                distance_to_center = tile_center_stage_positions[tile_index] - a_coordinates
 
                 # Calculation of annotation position is complicated, because of image rotation.
-                rotation = self.layers[self.annotation_tiles[annotation_name]['layers']]['rotation']
-                relative_x_stepsize = np.array([self.pixel_size * math.cos(rotation / 180 * math.pi),
-                                                self.pixel_size * math.sin(rotation / 180 * math.pi)])
-                relative_y_stepsize = np.array([self.pixel_size * math.sin(rotation / 180 * math.pi),
-                                                self.pixel_size * math.cos(rotation / 180 * math.pi)])
-
-                # Calculation based on the solution for the linear algebra problem Ax=b solved with Wolfram Alpha for x,
-                # A being the relative step_sizes, x the x & y shifts & b being the distance to center.
-                # This solution works for relative_y_stepsize[1] * relative_x_stepsize[0] !=
-                # relative_x_stepsize[1] * relative_y_stepsize[0] and relative_y_stepsize[1] != 0
-                # This generally seems to hold up for all rotations I have tried
-                try:
-                    x_shift = (relative_y_stepsize[1] * distance_to_center[0] - distance_to_center[1] *
-                               relative_y_stepsize[0]) / (relative_y_stepsize[1] * relative_x_stepsize[0] -
-                                                          relative_x_stepsize[1] * relative_y_stepsize[0])
-                    y_shift = (relative_x_stepsize[1] * distance_to_center[0] - distance_to_center[1] *
-                               relative_x_stepsize[0]) / (relative_x_stepsize[1] * relative_y_stepsize[0] -
-                                                          relative_y_stepsize[1] * relative_x_stepsize[0])
-
-                except ZeroDivisionError:
+                # The x & y shifts solve the linear algebra problem Ax=b, A having the relative step sizes of the layer
+                # as columns & b being the distance to center. The inverse of A is only calculated once per layer
+                layer_key = annotation_tile['layers']
+                if layer_key not in inverse_stepsizes:
+                    try:
+                        inverse_stepsizes[layer_key] = np.linalg.inv(self._layer_stepsizes[layer_key].T)
+                    except np.linalg.LinAlgError:
+                        inverse_stepsizes[layer_key] = None
+
+                if inverse_stepsizes[layer_key] is None:
                     logger.warning('Formula for the calculation of the annotation position within the image '
                                    'does not work for these parameters, a rotation of {} leads to divison by 0. The '
                                    'annotation marker is placed in the middle of the image because the location '
-                                   'could not be calculated'.format(rotation))
+                                   'could not be calculated'.format(self.layers[layer_key]['rotation']))
                     x_shift = 0
                     y_shift = 0
+                else:
+                    x_shift, y_shift = inverse_stepsizes[layer_key] @ distance_to_center
 
                 annotation_img_position = [int(round(self.img_height / 2 - x_shift)),
                                            int(round(self.img_width / 2 - y_shift))]
-                self.annotation_tiles[annotation_name]['Annotation_tile_img_position_x'] = annotation_img_position[0]
-                self.annotation_tiles[annotation_name]['Annotation_tile_img_position_y'] = annotation_img_position[1]
+                annotation_tile['Annotation_tile_img_position_x'] = annotation_img_position[0]
+                annotation_tile['Annotation_tile_img_position_y'] = annotation_img_position[1]
 
             else:
                 logger.warning('Annotation {} is not within any of the tiles and will be ignored'
@@ -633,29 +855,81 @@ class MapsXmlParser:
         of the surrounding filenames to surrounding_tile_names of the annotation_tiles dictionary
 
         """
+        # The image folder of each layer is listed once with os.scandir, instead of checking every surrounding tile of
+        # every annotation with a separate stat call
+        layer_files = {}
+
         # Take in the center tile and determine the names & existence of stitch_radius tiles around it.
         # In default stitch-radius = 1, it searches for the 8 tiles surrounding the center tile
-        for annotation_name in self.annotation_tiles:
-            center_filename = self.annotation_tiles[annotation_name]['filename']
+        for annotation_tile in self.annotation_tiles.values():
+            center_filename = annotation_tile['filename']
+
+            layer = annotation_tile['layers']
+            if layer not in layer_files:
+                layer_files[layer] = self._list_files(annotation_tile['img_path'])
+            existing_files = layer_files[layer]
+
+            # Create the filenames and check whether those files exist
+            filename_match = _TILE_FILENAME_REGEX.match(center_filename)
+            if filename_match is None:
+                raise XmlParsingFailed('The tile filename {} does not have the expected format (e.g. '
+                                       'Tile_001-002-000000_0-000.tif)'.format(center_filename))
+            prefix, x, y, suffix = filename_match.group(1), int(filename_match.group(2)), \
+                int(filename_match.group(3)), filename_match.group(4)
+            annotation_tile['surrounding_tile_names'] = [
+                f'{prefix}{x + i:03}-{y + j:03}{suffix}' for i, j in self._surrounding_offsets]
+            annotation_tile['surrounding_tile_exists'] = [
+                name in existing_files for name in annotation_tile['surrounding_tile_names']]
 
-            self.annotation_tiles[annotation_name]['surrounding_tile_names'] = []
-            self.annotation_tiles[annotation_name]['surrounding_tile_exists'] = []
+    @staticmethod
+    def _list_files(folder_path):
+        """Returns the names of all files in a folder
 
-            x = int(center_filename[5:8])
-            y = int(center_filename[9:12])
-            for i in range(-self.stitch_radius, self.stitch_radius + 1):
-                for j in range(-self.stitch_radius, self.stitch_radius + 1):
-                    # Create the filenames
-                    new_filename = center_filename[:5] + f'{x + i:03}' + '-' + f'{y + j:03}' + center_filename[12:]
-                    self.annotation_tiles[annotation_name]['surrounding_tile_names'].append(new_filename)
+        Args:
+            folder_path (Path): Path to the folder
 
-                    # Check whether those files exist
-                    img_path = self.annotation_tiles[annotation_name]['img_path'] / new_filename
+        Returns:
+            frozenset: The names of the files in the folder. Empty if the folder doesn't exist
 
-                    if img_path.is_file():
-                        self.annotation_tiles[annotation_name]['surrounding_tile_exists'].append(True)
-                    else:
-                        self.annotation_tiles[annotation_name]['surrounding_tile_exists'].append(False)
+        """
+        try:
+            with os.scandir(str(folder_path)) as entries:
+                return frozenset(entry.name for entry in entries if entry.is_file())
+        except OSError:
+            return frozenset()
+
+    @staticmethod
+    def annotation_tiles_to_dataframe(annotation_tiles, base_header):
+        """Creates a dataframe of the annotation_tiles with the layout of the annotation csv files
+
+        The columns are the Image name, the base_header and the keys of the annotation_tiles. Lists are converted to
+        strings (e.g. '[True,False]'), paths to strings and the base_header columns are empty. The values are kept as
+        python objects, such that they are written exactly as they are (e.g. integers are not converted to floats
+        because of a missing value in another row)
+
+        Args:
+            annotation_tiles (dict): annotation tiles dictionary with a structure like self.annotation_tiles
+            base_header (list): list of strings that will be headers but will not contain any content
+
+        Returns:
+            pd.DataFrame: Dataframe with one row per annotation
+
+        """
+        header_addition = list(next(iter(annotation_tiles.values()))) if annotation_tiles else []
+        rows = []
+        for annotation_name in annotation_tiles:
+            current_annotation = {'Image': annotation_name}
+            current_annotation.update(dict.fromkeys(base_header))
+            current_annotation.update(annotation_tiles[annotation_name])
+
+            for info_key, info_value in annotation_tiles[annotation_name].items():
+                if type(info_value) == list:
+                    current_annotation[info_key] = '[' + ','.join(map(str, info_value)) + ']'
+                elif isinstance(info_value, Path):
+                    current_annotation[info_key] = str(info_value)
+            rows.append(current_annotation)
+
+        return pd.DataFrame(rows, columns=['Image'] + base_header + header_addition, dtype=object)
 
     @staticmethod
     def save_annotation_tiles_to_csv(annotation_tiles, base_header, csv_path, batch_size=0):
@@ -677,45 +951,22 @@ class MapsXmlParser:
         """
         assert (str(csv_path).endswith('.csv'))
         csv_files = []
-        # Initialize empty csv file (or csv files if batch mode is used)
-        base_header_2 = ['Image'] + base_header
         # If there are annotations, save them. Otherwise, log a warning.
         if annotation_tiles:
-            header_addition = list(list(annotation_tiles.values())[0].keys())
+            # Write each csv file at once
+            annotations_pd = MapsXmlParser.annotation_tiles_to_dataframe(annotation_tiles, base_header)
+
+            # Default: everything is saved into one csv file
             if batch_size == 0:
-                csv_header = pd.DataFrame(columns=base_header_2 + header_addition)
-                csv_header.to_csv(str(csv_path), index=False)
+                annotations_pd.to_csv(str(csv_path), index=False)
                 csv_files.append(str(csv_path))
             else:
                 nb_batches = int(math.ceil(len(annotation_tiles.keys()) / batch_size))
                 for j in range(nb_batches):
                     csv_batch_path = str(csv_path)[:-4] + '_{}.csv'.format(f'{j:05}')
-                    csv_header = pd.DataFrame(columns=base_header_2 + header_addition)
-                    csv_header.to_csv(csv_batch_path, index=False)
+                    annotations_pd.iloc[j * batch_size:(j + 1) * batch_size].to_csv(csv_batch_path, index=False)
                     csv_files.append(csv_batch_path)
 
-            for i, annotation_name in enumerate(annotation_tiles):
-                current_annotation = {'Image': annotation_name}
-                for header in base_header:
-                    current_annotation[header] = ''
-
-                for info_key in annotation_tiles[annotation_name]:
-                    current_annotation[info_key] = annotation_tiles[annotation_name][info_key]
-                    if type(current_annotation[info_key]) == list:
-                        current_annotation[info_key] = '[' + ','.join(map(str, current_annotation[info_key])) + ']'
-
-                current_annotation_pd = pd.DataFrame(current_annotation, index=[0])
-
-                # Default: everything is saved into one csv file
-                if batch_size == 0:
-                    with open(str(csv_path), 'a') as f:
-                        current_annotation_pd.to_csv(f, header=False, index=False)
-                else:
-                    current_batch = int(i / batch_size)
-                    csv_batch_path = str(csv_path)[:-4] + '_{}.csv'.format(f'{current_batch:05}')
-                    with open(str(csv_batch_path), 'a') as f:
-                        current_annotation_pd.to_csv(f, header=False, index=False)
-
             return csv_files
 
         else:
@@ -738,25 +989,21 @@ class MapsXmlParser:
         """
         annotation_tiles = {}
         annotation_dataframe = pd.read_csv(str(csv_path))
-        column_names = list(annotation_dataframe.columns.values)
-        # Loop through all the rows of the dataframe, add them one by one to the annotation tiles
-        for index, row in annotation_dataframe.iterrows():
-            annotation_tiles[row['Image']] = {}
-
-            # Loop through all the columns of the dataframe. If they are not part of the base header or the Image name,
-            # add them to the dictionary
-            for column in column_names:
-                if column not in base_header + ['Image']:
-                    if column == 'surrounding_tile_names':
-                        content_list = row[column].strip('[]').split(',')
-                        annotation_tiles[row['Image']][column] = content_list
-                    elif column == 'surrounding_tile_exists':
-                        content_list = [i == 'True' for i in row[column].strip('[]').split(',')]
-                        annotation_tiles[row['Image']][column] = content_list
-                    elif column == 'img_path':
-                        annotation_tiles[row['Image']][column] = Path(row[column])
-                    else:
-                        annotation_tiles[row['Image']][column] = row[column]
+        # Only keep the columns that are not part of the base header or the Image name
+        content_columns = [column for column in annotation_dataframe.columns.values
+                           if column not in base_header and column != 'Image']
+        annotation_contents = annotation_dataframe[content_columns].to_dict(orient='records')
+
+        for annotation_name, annotation_content in zip(annotation_dataframe['Image'], annotation_contents):
+            if 'surrounding_tile_names' in annotation_content:
+                annotation_content['surrounding_tile_names'] = \
+                    annotation_content['surrounding_tile_names'].strip('[]').split(',')
+            if 'surrounding_tile_exists' in annotation_content:
+                annotation_content['surrounding_tile_exists'] = \
+                    [i == 'True' for i in annotation_content['surrounding_tile_exists'].strip('[]').split(',')]
+            if 'img_path' in annotation_content:
+                annotation_content['img_path'] = Path(annotation_content['img_path'])
+            annotation_tiles[annotation_name] = annotation_content
 
         return annotation_tiles
 
@@ -788,7 +1035,7 @@ class MapsXmlParser:
             for tile_set in csv_reader:
                 tile_set_name = tile_set[0]
                 tile = ast.literal_eval(tile_set[1])
-                tile_name = list(tile.keys())[0]
+                tile_name = next(iter(tile))
                 tile_key = tile_set_name + '_' + tile_name
                 annotations_per_tileset[tile_key] = tile
         # Parse the MAPS experiment (without annotations) to get the positions of all tiles
@@ -797,27 +1044,24 @@ class MapsXmlParser:
         self.calculate_absolute_tile_coordinates()
 
         # Map the annotations to the corresponding tiles
-        for current_tile_set in annotations_per_tileset:
-            for tile in annotations_per_tileset[current_tile_set]:
-                current_tile = self.tiles[current_tile_set]
-                for annotation_key in annotations_per_tileset[current_tile_set][tile]:
+        for current_tile_set, tile in annotations_per_tileset.items():
+            for tile_annotations in tile.values():
+                for annotation in tile_annotations.values():
                     # Get Annotation_Names => Create increasing names
                     annotation_index += 1
                     annotation_name = base_annotation_name + str(annotation_index).zfill(5)
-                    annotation = annotations_per_tileset[current_tile_set][tile][annotation_key]
                     # The annotation tuple could contain more info (e.g. probability) that is not currently
                     # saved anywhere
 
-                    self.annotation_tiles[annotation_name] = copy.deepcopy(current_tile)
-                    self.annotation_tiles[annotation_name]['pixel_size'] = self.pixel_size
+                    annotation_tile = self.get_tile_info(current_tile_set)
+                    self.annotation_tiles[annotation_name] = annotation_tile
+                    annotation_tile['pixel_size'] = self.pixel_size
                     # If relevant, the StagePositions could be calculated and added here. As they are only used to find
                     # the tile of interest and the classifier output already provides that, it's not done here
-                    self.annotation_tiles[annotation_name]['Annotation_StagePosition_x'] = None
-                    self.annotation_tiles[annotation_name]['Annotation_StagePosition_y'] = None
-                    self.annotation_tiles[annotation_name]['Annotation_tile_img_position_x'] = annotation[0] \
-                                                                                               + annotation_shift
-                    self.annotation_tiles[annotation_name]['Annotation_tile_img_position_y'] = annotation[1] \
-                                                                                               + annotation_shift
+                    annotation_tile['Annotation_StagePosition_x'] = None
+                    annotation_tile['Annotation_StagePosition_y'] = None
+                    annotation_tile['Annotation_tile_img_position_x'] = annotation[0] + annotation_shift
+                    annotation_tile['Annotation_tile_img_position_y'] = annotation[1] + annotation_shift
         self.determine_surrounding_tiles()
         return self.annotation_tiles
 
@@ -4,8 +4,11 @@ import re
 import numpy as np
 import multiprocessing
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from StyleFrame import StyleFrame, Styler
+from openpyxl.utils import get_column_letter
 
 import sites_of_interest_parser as sip
 import os
@@ -18,6 +21,79 @@ import imagej
 # https://forum.image.sc/t/using-imagej-functions-like-type-conversion-and-setting-pixel-size-via-pyimagej/25755/10
 ij = imagej.init('sc.fiji:fiji:2.0.0-pre-10+ch.fmi:faim-ij2-visiview-processing:0.0.1')
 
+# Starting positions of the tiles for the different stitching layouts (3x3, 3 columns x 2 rows, 2 columns x 3 rows and
+# 2x2), based on the size of the Talos images and an overlap of 10%. Defined once instead of per annotation
+# TODO: Calculate these starting positions based on the overlap metadata
+_POS_3X3 = np.array([[0.0, 0.0], [3686.0, 0.0], [7373.0, 0.0], [0.0, 3686.0], [3686.0, 3686.0], [7373.0, 3686.0],
+                     [0.0, 7373.0], [3686.0, 7373.0], [7373.0, 7373.0]], dtype=np.float64)
+_POS_3X2 = np.array([[0.0, 0.0], [3686.0, 0.0], [7373.0, 0.0], [0.0, 3686.0], [3686.0, 3686.0], [7373.0, 3686.0]],
+                    dtype=np.float64)
+_POS_2X3 = np.array([[0.0, 0.0], [3686.0, 0.0], [0.0, 3686.0], [3686.0, 3686.0], [0.0, 7373.0], [3686.0, 7373.0]],
+                    dtype=np.float64)
+_POS_2X2 = np.array([[0.0, 0.0], [3686.0, 0.0], [0.0, 3686.0], [3686.0, 3686.0]], dtype=np.float64)
+
+
+def _tile_exists_mask(surrounding_tile_exists):
+    """Packs the surrounding_tile_exists list of an annotation into a bitmask (bit k is set if tile k exists)
+
+    Args:
+        surrounding_tile_exists (list): List of booleans of whether each of the surrounding tiles exist
+
+    Returns:
+        int: The bitmask of the existing tiles
+
+    """
+    mask = 0
+    for k, tile_exists in enumerate(surrounding_tile_exists):
+        if tile_exists:
+            mask |= 1 << k
+    return mask
+
+
+# The starting positions and the index of the center tile for every surrounding_tile_exists pattern that can be
+# stitched, keyed by the bitmask of the pattern. A single dictionary lookup per annotation selects the layout
+# TODO: Change center_index calculation to: Sum of existing tiles before the center tile, based on the
+#  surrounding_tile_exists list
+_STITCHING_LAYOUTS = {
+    # All tiles exist
+    _tile_exists_mask([True, True, True, True, True, True, True, True, True]): (_POS_3X3, 4),
+    # Edge tile: Top or bottom row is missing
+    _tile_exists_mask([True, True, True, True, True, True, False, False, False]): (_POS_3X2, 4),
+    _tile_exists_mask([False, False, False, True, True, True, True, True, True]): (_POS_3X2, 1),
+    # Edge tile: Left or right column is missing
+    _tile_exists_mask([False, True, True, False, True, True, False, True, True]): (_POS_2X3, 2),
+    _tile_exists_mask([True, True, False, True, True, False, True, True, False]): (_POS_2X3, 3),
+    # Corner Tile: Only 2x2 tiles to stitch
+    _tile_exists_mask([True, True, False, True, True, False, False, False, False]): (_POS_2X2, 3),
+    _tile_exists_mask([False, True, True, False, True, True, False, False, False]): (_POS_2X2, 2),
+    _tile_exists_mask([False, False, False, True, True, False, True, True, False]): (_POS_2X2, 1),
+    _tile_exists_mask([False, False, False, False, True, True, False, True, True]): (_POS_2X2, 0),
+}
+
+# Filenames of the annotation csv batches created by parse_create_csv_batches
+_ANNOTATION_CSV_REGEX = re.compile(r'_annotations_\d+\.csv\Z')
+
+# Java classes that were already loaded via jnius. Avoids repeating the reflection lookup of autoclass every time a
+# class is used
+_JCLASSES = {}
+
+
+def _jclass(name: str):
+    """Returns the Java class with the given name, loading it via jnius autoclass on first use
+
+    Args:
+        name (str): Fully qualified name of the Java class
+
+    Returns:
+        The jnius wrapper of the Java class
+
+    """
+    java_class = _JCLASSES.get(name)
+    if java_class is None:
+        from jnius import autoclass
+        java_class = _JCLASSES.setdefault(name, autoclass(name))
+    return java_class
+
 
 class Stitcher:
     """ Stitches Talos images based on csv files containing the necessary information
@@ -36,10 +112,13 @@ class Stitcher:
         output_folder (str): Name of the folder where the stitched forks are saved to
         stitch_radius (int): The number of images in each direction from the tile containing the annotation should be
             stitched.
+        close_batch_size (int): The number of annotations whose images are kept open before they are closed together.
+            Defaults to 8. Images are closed earlier if the JVM runs low on memory
 
     Attributes:
         stitch_radius (int): The number of images in each direction from the tile containing the annotation should be
             stitched.
+        close_batch_size (int): The number of annotations whose images are kept open before they are closed together
         project_name (str): Name of the current project being processed
         project_folder_path (Path): Full path to the project folder, containing the MAPSProject.xml file and the
             LayersData folder
@@ -50,8 +129,9 @@ class Stitcher:
 
     """
     def __init__(self, base_path: str, project_name: str, csv_folder: str = 'annotation_csv',
-                 output_folder: str = 'stitchedForks', stitch_radius: int = 1):
+                 output_folder: str = 'stitchedForks', stitch_radius: int = 1, close_batch_size: int = 8):
         self.stitch_radius = stitch_radius
+        self.close_batch_size = close_batch_size
 
         self.project_name = project_name
         self.project_folder_path = Path(base_path) / project_name
@@ -72,15 +152,16 @@ class Stitcher:
                             ]
 
     def stitch_annotated_tiles(self, annotation_tiles: dict, logger, stitch_threshold: int = 1000,
-                               eight_bit: bool = True, show_arrow: bool = True, enhance_contrast: bool = True):
+                               eight_bit: bool = True, show_arrow: bool = True, enhance_contrast: bool = True,
+                               defer_eight_bit: bool = False, enhance_contrast_mode: str = 'tile'):
         """Stitches 3x3 images for all annotations in annotation_tiles
 
         Goes through all annotations in annotation_tiles dict, load the center file and the existing surrounding files.
         Sets up the stitching configuration according to the neighboring tiles and calculates the stitching parameters.
         If the calculated stitching moves all images by less than the threshold in any direction, it performs the
         stitching. Otherwise, a log message is made and the center image is copied to the results folder.
-        Finally, it sets the pixel size and converts the stitched image to 8bit before saving it to disk. Everything is
-        performed using pyimagej api to use imageJ Java APIs.
+        Finally, it sets the pixel size and saves the stitched image to disk (fused directly as an 8bit image if
+        eight_bit is True). Everything is performed using pyimagej api to use imageJ Java APIs.
         Can deal with 3x3, 3x2, 2x3 and 2x2 squares with 10% overlap.
 
         Args:
@@ -98,194 +179,317 @@ class Stitcher:
                 the stitched image. Defaults to True, thus adding an arrow to the overlay
             enhance_contrast (bool): Whether contrast enhancement should be performed on the images before stitching.
                 Defaults to True (thus enhancing contrast in the images)
+            defer_eight_bit (bool): Whether the 8bit conversion should be done once on the stitched image instead of on
+                each tile before stitching. Only has an effect if eight_bit is True. Defaults to False, thus converting
+                the tiles and fusing them directly into an 8bit image
+            enhance_contrast_mode (str): How the contrast enhancement is performed if enhance_contrast is True. 'tile'
+                (default) runs NormalizeLocalContrast on each tile separately, 'joint' runs it on each tile together
+                with the overlapping parts of its neighbors, which is slower (see joint_local_contrast_enhancement)
 
         Returns:
             dict: annotation_tiles, now includes information about the position of the annotation in the stitched image
 
         """
-        from jnius import autoclass
-
-        for annotation_name in annotation_tiles:
-            number_existing_neighbor_tiles = sum(annotation_tiles[annotation_name]['surrounding_tile_exists'])
-
-            logger.info('Stitching {}'.format(annotation_name))
-            img_path = annotation_tiles[annotation_name]['img_path']
-
-            imps = []
-
-            for i, neighbor in enumerate(annotation_tiles[annotation_name]['surrounding_tile_names']):
-                if annotation_tiles[annotation_name]['surrounding_tile_exists'][i]:
-                    imps.append(self.local_contrast_enhancement(str(img_path / neighbor), '', logger, save_img=False,
-                                                                eight_bit=eight_bit,
-                                                                use_norm_local_contrast=enhance_contrast,
-                                                                return_java_img=True, center=True))
-            java_imgs = ij.py.to_java(imps)
-
-            # Define starting positions based on what neighbor tiles exist
-            # TODO: Calculate these starting positions based on the overlap metadata
-            positions_jlist = ij.py.to_java([])
-            # All tiles exist
-            if number_existing_neighbor_tiles == 9:
-                positions = [[0.0, 0.0], [3686.0, 0.0], [7373.0, 0.0], [0.0, 3686.0], [3686.0, 3686.0],
-                             [7373.0, 3686.0], [0.0, 7373.0], [3686.0, 7373.0], [7373.0, 7373.0]]
-                # TODO: Change center_index calculation to: Sum of existing tiles before the center tile, based on the
-                #  surrounding_tile_exists list
-                center_index = 4
-            # Edge tile: Top or bottom row is missing
-            elif annotation_tiles[annotation_name]['surrounding_tile_exists'] == [True, True, True, True, True, True,
-                                                                                  False, False, False]:
-                positions = [[0.0, 0.0], [3686.0, 0.0], [7373.0, 0.0], [0.0, 3686.0], [3686.0, 3686.0],
-                             [7373.0, 3686.0]]
-                center_index = 4
-            elif annotation_tiles[annotation_name]['surrounding_tile_exists'] == [False, False, False, True, True,
-                                                                                  True, True, True, True]:
-                positions = [[0.0, 0.0], [3686.0, 0.0], [7373.0, 0.0], [0.0, 3686.0], [3686.0, 3686.0],
-                             [7373.0, 3686.0]]
-                center_index = 1
-            # Edge tile: Left or right column is missing
-            elif annotation_tiles[annotation_name]['surrounding_tile_exists'] == [False, True, True, False, True, True,
-                                                                                  False, True, True]:
-                positions = [[0.0, 0.0], [3686.0, 0.0], [0.0, 3686.0], [3686.0, 3686.0], [0.0, 7373.0],
-                             [3686.0, 7373.0]]
-                center_index = 2
-            elif annotation_tiles[annotation_name]['surrounding_tile_exists'] == [True, True, False, True, True,
-                                                                                  False, True, True, False]:
-                positions = [[0.0, 0.0], [3686.0, 0.0], [0.0, 3686.0], [3686.0, 3686.0], [0.0, 7373.0],
-                             [3686.0, 7373.0]]
-                center_index = 3
-            # Corner Tile: Only 2x2 tiles to stitch
-            elif number_existing_neighbor_tiles == 4:
-                positions = [[0.0, 0.0], [3686.0, 0.0], [0.0, 3686.0], [3686.0, 3686.0]]
-                if annotation_tiles[annotation_name]['surrounding_tile_exists'] == [True, True, False, True, True,
-                                                                                    False, False, False, False]:
-                    center_index = 3
-                elif annotation_tiles[annotation_name]['surrounding_tile_exists'] == [False, True, True, False, True,
-                                                                                      True, False, False, False]:
-                    center_index = 2
-                elif annotation_tiles[annotation_name]['surrounding_tile_exists'] == [False, False, False, True, True,
-                                                                                      False, True, True, False]:
-                    center_index = 1
-                elif annotation_tiles[annotation_name]['surrounding_tile_exists'] == [False, False, False, False, True,
-                                                                                      True, False, True, True]:
-                    center_index = 0
-                else:
+        ArrayList = _jclass('java.util.ArrayList')
+        # The pixel size is usually the same for all annotations, so the Properties command is only built once per
+        # pixel size
+        pixel_size_commands = {}
+        # computeStitching only reads the starting positions, so the Java list of the positions is built once per
+        # stitching layout and shared by all annotations with that layout
+        positions_jlists = {}
+        fusion_executor = ThreadPoolExecutor(max_workers=1)
+        fusion_future = None
+        fusion_images = None
+        # Images are closed in batches of annotations instead of after every annotation to reduce the cleanup overhead
+        # in the JVM
+        pending_close = []
+
+        annotation_images = None
+        try:
+            for annotation_name in annotation_tiles:
+                logger.info('Stitching {}'.format(annotation_name))
+                img_path = annotation_tiles[annotation_name]['img_path']
+
+                # Define starting positions based on what neighbor tiles exist
+                surrounding_tile_exists = annotation_tiles[annotation_name]['surrounding_tile_exists']
+                layout = None
+                if len(surrounding_tile_exists) == 9:
+                    layout = _STITCHING_LAYOUTS.get(_tile_exists_mask(surrounding_tile_exists))
+
+                if layout is None:
                     logger.warning('Not stitching fork {}, because there is no rectangle of images to stitch. '
                                    'This stitching function is only made for 3x3, 2x3, 3x2 and 2x2 stitching. '
-                                   'Those tiles do exist: {}'.format(annotation_name,
-                                                                     annotation_tiles[annotation_name]
-                                                                     ['surrounding_tile_exists']))
+                                   'Those tiles do exist: {}'.format(annotation_name, surrounding_tile_exists))
                     # Instead of stitching, copy the center tile to the output folder
                     center_file_path = Path(img_path) / annotation_tiles[annotation_name]['surrounding_tile_names'][4]
                     output_filename = self.output_path / (annotation_name + '_StitchingFailed_centerOnly.tiff')
-                    shutil.copy(center_file_path, output_filename)
+                    self._copy_file(center_file_path, output_filename)
                     break
+                positions, center_index = layout
+
+                positions_jlist = positions_jlists.get(id(positions))
+                if positions_jlist is None:
+                    positions_jlist = ij.py.to_java([])
+                    for pos in positions.tolist():
+                        positions_jlist.add(pos)
+                    positions_jlists[id(positions)] = positions_jlist
+                original_positions = positions
+
+                # The tile paths are only needed as strings for ImageJ, so they are joined as strings instead of via
+                # Path
+                img_folder = os.fspath(img_path)
+                tile_paths = [os.path.join(img_folder, neighbor) for neighbor, tile_exists in
+                              zip(annotation_tiles[annotation_name]['surrounding_tile_names'],
+                                  annotation_tiles[annotation_name]['surrounding_tile_exists'])
+                              if tile_exists]
+                # Keep track of the images of the current annotation, such that they are also closed if stitching fails
+                imps = []
+                annotation_images = (imps, [])
+                if enhance_contrast and enhance_contrast_mode == 'joint':
+                    imps.extend(self.joint_local_contrast_enhancement(tile_paths, positions, logger,
+                                                                      eight_bit=eight_bit,
+                                                                      defer_eight_bit=defer_eight_bit, center=True))
+                else:
+                    for tile_path in tile_paths:
+                        imps.append(self.local_contrast_enhancement(tile_path, '', logger, save_img=False,
+                                                                    eight_bit=eight_bit,
+                                                                    defer_eight_bit=defer_eight_bit,
+                                                                    use_norm_local_contrast=enhance_contrast,
+                                                                    return_java_img=True, center=True))
+                # The ImagePlus objects are already Java objects, so they are added to a Java list directly instead of
+                # going through the pyimagej conversion
+                java_imgs = ArrayList(len(imps))
+                for imp in imps:
+                    java_imgs.add(imp)
+                annotation_images = (imps, java_imgs)
+
+                dimensionality = 2
+                compute_overlap = True
+                StitchingUtils = _jclass('ch.fmi.visiview.StitchingUtils')
+                models = StitchingUtils.computeStitching(java_imgs, positions_jlist, dimensionality, compute_overlap)
+
+                # Get the information about how much the center image has been shifted, where the fork is placed in
+                # the stitched image
+                # The translation is stored in the last two of the 6 model parameters. The parameter buffer and the
+                # output array are allocated once per annotation instead of once per model
+                params = [0.0] * 6
+                stitching_params = np.empty((len(models), 2), dtype=np.float64)
+                for i, model in enumerate(models):
+                    model.toArray(params)
+                    stitching_params[i, 0] = params[4]
+                    stitching_params[i, 1] = params[5]
+
+                original_annotation_coord = [annotation_tiles[annotation_name]['Annotation_tile_img_position_x'],
+                                             annotation_tiles[annotation_name]['Annotation_tile_img_position_y']]
+
+                [perform_stitching, stitched_coordinates] = self.process_stitching_params(stitching_params,
+                                                                                          original_annotation_coord,
+                                                                                          stitch_threshold,
+                                                                                          original_positions,
+                                                                                          center_index,
+                                                                                          logger)
+
+                # If the calculate stitching is reasonable, perform the stitching. Otherwise, log a warning
+                if perform_stitching:
+                    # Add the information about where the fork is in the stitched image back to the dictionary,
+                    # such that it can be saved to csv afterwards
+                    annotation_tiles[annotation_name]['annotation_position_x'] = stitched_coordinates[0]
+                    annotation_tiles[annotation_name]['annotation_position_y'] = stitched_coordinates[1]
+
+                    # Set the pixel size. Fiji rounds 0.499 nm to 0.5 nm and I can't see anything I can do about that
+                    pixel_size = annotation_tiles[annotation_name]['pixel_size']
+                    if pixel_size not in pixel_size_commands:
+                        pixel_size_nm = str(pixel_size * 1e9)
+                        pixel_size_commands[pixel_size] = "channels=1 slices=1 frames=1 unit=nm pixel_width=" + \
+                                                          pixel_size_nm + " pixel_height=" + pixel_size_nm + \
+                                                          " voxel_depth=1.0 global"
+
+                    # The fusion runs in the background while the next annotation is prepared. Only one fusion runs at a
+                    # time, so wait for the previous one to finish first to limit the memory usage
+                    if fusion_future is not None:
+                        fusion_future.result()
+                        pending_close.append(fusion_images)
+                        fusion_future = None
+                    fusion_future = fusion_executor.submit(self._fuse_and_save, annotation_name, java_imgs, models,
+                                                           stitched_coordinates, pixel_size_commands[pixel_size],
+                                                           eight_bit, defer_eight_bit, show_arrow)
+                    fusion_images = annotation_images
+                    annotation_images = None
 
-            else:
-                logger.warning('Not stitching fork {}, because there is no rectangle of images to stitch. '
-                               'This stitching function is only made for 3x3, 2x3, 3x2 and 2x2 stitching. '
-                               'Those tiles do exist: {}'.format(annotation_name, annotation_tiles[annotation_name]
-                                                                                        ['surrounding_tile_exists']))
-                # Instead of stitching, copy the center tile to the output folder
-                center_file_path = Path(img_path) / annotation_tiles[annotation_name]['surrounding_tile_names'][4]
-                output_filename = self.output_path / (annotation_name + '_StitchingFailed_centerOnly.tiff')
-                shutil.copy(center_file_path, output_filename)
-                break
-
-            for pos in positions:
-                positions_jlist.add(pos)
-            original_positions = np.array(positions_jlist)
+                else:
+                    logger.warning('Not stitching fork {}, because the stitching calculations displaced the images '
+                                   'more than {} pixels. Instead, just copying the center image to the target folder'
+                                   .format(annotation_name, stitch_threshold))
+                    center_file_path = Path(img_path) / annotation_tiles[annotation_name]['surrounding_tile_names'][4]
+                    output_filename = self.output_path / (annotation_name + '_StitchingFailed_centerOnly.tiff')
+                    self._copy_file(center_file_path, output_filename)
+                    # Save the original positions to the file. Otherwise, the csv files have missing entries which can
+                    # lead to issues.
+                    annotation_tiles[annotation_name]['annotation_position_x'] = annotation_tiles[annotation_name]['Annotation_tile_img_position_x']
+                    annotation_tiles[annotation_name]['annotation_position_y'] = annotation_tiles[annotation_name]['Annotation_tile_img_position_y']
+
+                    pending_close.append(annotation_images)
+                    annotation_images = None
+
+                # Close the images once enough annotations have accumulated or if the JVM is running low on memory
+                if len(pending_close) >= self.close_batch_size or self._jvm_memory_low():
+                    self._close_images(pending_close)
+                    pending_close = []
+
+            # Wait for the last fusion to finish (and raise any exception that happened during the fusion)
+            if fusion_future is not None:
+                fusion_future.result()
+        finally:
+            # Also clean up if stitching an annotation failed, as the process goes on to stitch other batches: Wait for
+            # a running fusion to finish before its images are closed and close the images of the current annotation
+            fusion_executor.shutdown(wait=True)
+            if fusion_future is not None:
+                pending_close.append(fusion_images)
+            if annotation_images is not None:
+                pending_close.append(annotation_images)
+            self._close_images(pending_close)
 
+        # return the annotation_tiles dictionary that now contains the information about where the fork is in the
+        # stitched image
+        return annotation_tiles
+
+    def _fuse_and_save(self, annotation_name, java_imgs, models, stitched_coordinates, pixel_size_command,
+                       eight_bit: bool, defer_eight_bit: bool, show_arrow: bool):
+        """Fuses the tiles of an annotation based on the calculated stitching and saves the stitched image
+
+        Runs in a background thread of stitch_annotated_tiles, such that the fusion can run in the JVM while the next
+        annotation is prepared. The tiles are not closed here, but in batches by stitch_annotated_tiles.
+
+        Args:
+            annotation_name (str): Name of the annotation, used as the filename of the stitched image
+            java_imgs: Java list of the ImagePlus images to be fused, as passed to the stitching
+            models: The models calculated by computeStitching for the images
+            stitched_coordinates (np.array): Coordinates of the annotation in the stitched image
+            pixel_size_command (str): Options for the ImageJ Properties command that sets the pixel size
+            eight_bit (bool): Whether the stitched image should be saved as an 8bit image
+            defer_eight_bit (bool): Whether the 8bit conversion of the tiles was deferred to the stitched image
+            show_arrow (bool): Whether an arrow should be added to the image overlay that points to the annotation in
+                the stitched image
+
+        """
+        from jnius import detach
+
+        try:
             dimensionality = 2
-            compute_overlap = True
-            StitchingUtils = autoclass('ch.fmi.visiview.StitchingUtils')
-            models = StitchingUtils.computeStitching(java_imgs, positions_jlist, dimensionality, compute_overlap)
-
-            # Get the information about how much the center image has been shifted, where the fork is placed in
-            # the stitched image
-            stitching_params = []
-            for model in models:
-                params = [0.0] * 6
-                model.toArray(params)
-                stitching_params.append(params[4:])
-
-            original_annotation_coord = [annotation_tiles[annotation_name]['Annotation_tile_img_position_x'],
-                                         annotation_tiles[annotation_name]['Annotation_tile_img_position_y']]
-
-            [perform_stitching, stitched_coordinates] = self.process_stitching_params(stitching_params,
-                                                                                      original_annotation_coord,
-                                                                                      stitch_threshold,
-                                                                                      original_positions, center_index,
-                                                                                      logger)
-
-            # If the calculate stitching is reasonable, perform the stitching. Otherwise, log a warning
-            if perform_stitching:
-                # Add the information about where the fork is in the stitched image back to the dictionary,
-                # such that it can be saved to csv afterwards
-                annotation_tiles[annotation_name]['annotation_position_x'] = stitched_coordinates[0]
-                annotation_tiles[annotation_name]['annotation_position_y'] = stitched_coordinates[1]
-
-                Fusion = autoclass('mpicbg.stitching.fusion.Fusion')
-                UnsignedShortType = autoclass('net.imglib2.type.numeric.integer.UnsignedShortType')
+            Fusion = _jclass('mpicbg.stitching.fusion.Fusion')
+            # Fuse directly into an 8 bit image if an 8 bit output is requested. The tiles are already converted to
+            # 8 bit, so nothing is lost and no 16 bit intermediate image has to be converted afterwards
+            if eight_bit and not defer_eight_bit:
+                UnsignedByteType = _jclass('net.imglib2.type.numeric.integer.UnsignedByteType')
+                target_type = UnsignedByteType()
+            else:
+                UnsignedShortType = _jclass('net.imglib2.type.numeric.integer.UnsignedShortType')
                 target_type = UnsignedShortType()
-                subpixel_accuracy = False
-                ignore_zero_values = False
-                stitched_img = Fusion.fuse(target_type, java_imgs, models, dimensionality, subpixel_accuracy, 5,
-                                           None, False, ignore_zero_values, False)
-
-                # # Use imageJ to set bit depth, pixel size & save the image.
-                IJ = autoclass('ij.IJ')
-
-                # Set the pixel size. Fiji rounds 0.499 nm to 0.5 nm and I can't see anything I can do about that
-                pixel_size_nm = str(annotation_tiles[annotation_name]['pixel_size'] * 10e8)
-                pixel_size_command = "channels=1 slices=1 frames=1 unit=nm pixel_width=" + pixel_size_nm + \
-                                     " pixel_height=" + pixel_size_nm + " voxel_depth=1.0 global"
-                IJ.run(stitched_img, "Properties...", pixel_size_command)
-
-                # Convert to 8 bit
-                if eight_bit:
-                    IJ.run(stitched_img, "8-bit", "")
-
-                # Add an arrow pointing to the annotation
-                if show_arrow:
-                    ArrowTool = autoclass('fiji.util.ArrowTool')
-                    ArrowStyle = autoclass('fiji.util.ArrowShape$ArrowStyle')
-                    roi = ArrowTool.makeRoi(ArrowStyle.DELTA, stitched_coordinates[0] - 400, stitched_coordinates[1]
-                                            + 400, stitched_coordinates[0] - 40, stitched_coordinates[1] + 40,
-                                            25.0, 50.0)
-
-                    Color = autoclass('java.awt.Color')
-                    stitched_img.setOverlay(roi, Color.green, 50, Color.green)
-
-                # Saving the ImagePlus directly as Tiff, without converting to ImageJ2 Dataset or converting to PNG,
-                # as both of those interfere with displaying the overlay arrow
-                output_filename = annotation_name + '.tiff'
-                IJ.saveAsTiff(stitched_img, str(self.output_path / output_filename))
-
-                stitched_img.close()
+            subpixel_accuracy = False
+            ignore_zero_values = False
+            stitched_img = Fusion.fuse(target_type, java_imgs, models, dimensionality, subpixel_accuracy, 5,
+                                       None, False, ignore_zero_values, False)
+
+            # # Use imageJ to set bit depth, pixel size & save the image.
+            IJ = _jclass('ij.IJ')
+            IJ.run(stitched_img, "Properties...", pixel_size_command)
+
+            # If the 8 bit conversion of the tiles was deferred, convert the stitched image once
+            if eight_bit and defer_eight_bit:
+                IJ.run(stitched_img, "8-bit", "")
+
+            # Add an arrow pointing to the annotation
+            if show_arrow:
+                ArrowTool = _jclass('fiji.util.ArrowTool')
+                ArrowStyle = _jclass('fiji.util.ArrowShape$ArrowStyle')
+                roi = ArrowTool.makeRoi(ArrowStyle.DELTA, stitched_coordinates[0] - 400, stitched_coordinates[1]
+                                        + 400, stitched_coordinates[0] - 40, stitched_coordinates[1] + 40,
+                                        25.0, 50.0)
+
+                Color = _jclass('java.awt.Color')
+                stitched_img.setOverlay(roi, Color.green, 50, Color.green)
+
+            # Saving the ImagePlus directly as Tiff, without converting to ImageJ2 Dataset or converting to PNG,
+            # as both of those interfere with displaying the overlay arrow. Uses the FileSaver directly instead of
+            # IJ.saveAsTiff, as the filename already has the correct extension
+            output_filename = annotation_name + '.tiff'
+            FileSaver = _jclass('ij.io.FileSaver')
+            FileSaver(stitched_img).saveAsTiff(str(self.output_path / output_filename))
+
+            stitched_img.close()
+
+        finally:
+            # Threads that used the JVM need to be detached from it
+            detach()
 
-            else:
-                logger.warning('Not stitching fork {}, because the stitching calculations displaced the images more '
-                               'than {} pixels. Instead, just copying the center image to the target folder'
-                               .format(annotation_name, stitch_threshold))
-                center_file_path = Path(img_path) / annotation_tiles[annotation_name]['surrounding_tile_names'][4]
-                output_filename = self.output_path / (annotation_name + '_StitchingFailed_centerOnly.tiff')
-                shutil.copy(center_file_path, output_filename)
-                # Save the original positions to the file. Otherwise, the csv files have missing entries which can lead
-                # to issues.
-                annotation_tiles[annotation_name]['annotation_position_x'] = annotation_tiles[annotation_name]['Annotation_tile_img_position_x']
-                annotation_tiles[annotation_name]['annotation_position_y'] = annotation_tiles[annotation_name]['Annotation_tile_img_position_y']
-
-            # Close any open images to free up RAM. Otherwise, get an OutOfMemory Exception after a few rounds
-            # ij.getContext().dispose()
-            for img in imps:
+    @staticmethod
+    def _close_images(pending_close):
+        """Closes the images of a batch of annotations to free up RAM
+
+        Otherwise, the JVM runs into an OutOfMemory Exception after a few rounds. The images are closed in the reverse
+        order of their creation and the ImageJ windows are cleared once for the whole batch.
+
+        Args:
+            pending_close (list): List of tuples of the list of ImagePlus images of an annotation and the Java list of
+                the same images
+
+        """
+        if not pending_close:
+            return
+        # ij.getContext().dispose()
+        for imps, java_imgs in reversed(pending_close):
+            for img in reversed(imps):
                 img.close()
             for java_img in java_imgs:
                 java_img.close()
-            ij.window().clear()
+        ij.window().clear()
 
-        # return the annotation_tiles dictionary that now contains the information about where the fork is in the
-        # stitched image
-        return annotation_tiles
+    @staticmethod
+    def _jvm_memory_low(min_free_fraction: float = 0.25):
+        """Checks whether the JVM is running low on memory
+
+        Args:
+            min_free_fraction (float): Fraction of the maximum JVM memory that should still be available. Defaults to
+                0.25
+
+        Returns:
+            bool: True if less than min_free_fraction of the maximum memory of the JVM is still available
+
+        """
+        runtime = _jclass('java.lang.Runtime').getRuntime()
+        available_memory = runtime.maxMemory() - runtime.totalMemory() + runtime.freeMemory()
+        return available_memory < min_free_fraction * runtime.maxMemory()
+
+    @staticmethod
+    def _copy_file(source_path, target_path):
+        """Copies a file, using an in-kernel copy where the OS supports it
+
+        On Linux (Python 3.8+), os.copy_file_range lets copy-on-write filesystems share the blocks of the file instead
+        of copying them. Like shutil.copy, the permission bits are copied as well. Falls back to shutil.copy on other
+        systems or if the in-kernel copy fails. Hardlinks are deliberately not used, as the target would then be the
+        same file as the raw data.
+
+        Args:
+            source_path (Path): Path to the file to be copied
+            target_path (Path): Path to where the copy should be created
+
+        """
+        if hasattr(os, 'copy_file_range'):
+            try:
+                with open(str(source_path), 'rb') as source, open(str(target_path), 'wb') as target:
+                    remaining = os.fstat(source.fileno()).st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(source.fileno(), target.fileno(), remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                if remaining == 0:
+                    # Copy the permission bits like shutil.copy does
+                    shutil.copymode(str(source_path), str(target_path))
+                    return
+            except OSError:
+                pass
+        shutil.copy(str(source_path), str(target_path))
 
     @staticmethod
     def process_stitching_params(stitch_params, annotation_coordinates, stitch_threshold, original_positions,
@@ -293,7 +497,7 @@ class Stitcher:
         """Calculates the position of the annotation in the stitched image and decides if stitching worked well
 
         Based on the stitch_threshold, this function decides whether the stitching has worked well. If any image was
-        moved by more than the threshold, it returns False.
+        moved by more than the threshold in any direction (positive or negative), it returns False.
 
         Args:
             stitch_params (np.array): Array of the stitching parameters calculated by imageJ stitching
@@ -311,20 +515,15 @@ class Stitcher:
                 the coordinates of the annotations in the stitched image
 
         """
-        nb_imgs = len(stitch_params)
-        stitch_coordinates = np.zeros((nb_imgs, 2))
-        for i, coordinates in enumerate(stitch_params):
-            stitch_coordinates[i, 0] = int(round(coordinates[0]))
-            stitch_coordinates[i, 1] = int(round(coordinates[1]))
+        # Round all coordinates at once (half to even, like the built-in round)
+        stitch_coordinates = np.rint(np.asarray(stitch_params, dtype=np.float64)).astype(np.int64)
         min_coords = np.min(stitch_coordinates, axis=0)
         stitched_annotation_coordinates = annotation_coordinates + stitch_coordinates[center_index, :] - min_coords
 
+        # Compare the magnitude of the shifts, such that images moved in negative direction are also caught
         stitch_shift = stitch_coordinates - original_positions
-        max_shift = np.max(stitch_shift)
-        if max_shift < stitch_threshold:
-            good_stitching = True
-        else:
-            good_stitching = False
+        good_stitching = bool(np.max(np.abs(stitch_shift)) < stitch_threshold)
+        if not good_stitching:
             logger.warning('Current stitching moves images more than the threshold of {}. '
                             'The stitching calculated the following image displacements from their '
                             'starting positions: {}.'.format(stitch_threshold, stitch_shift))
@@ -334,7 +533,8 @@ class Stitcher:
     @staticmethod
     def local_contrast_enhancement(img_path, output_path, logger=None, save_img: bool = False, eight_bit: bool = True,
                                    use_norm_local_contrast: bool = False, use_CLAHE: bool = False,
-                                   return_java_img: bool = False, return_numpy_img: bool = False, **kwargs):
+                                   return_java_img: bool = False, return_numpy_img: bool = False,
+                                   defer_eight_bit: bool = False, **kwargs):
         """Loads an image and performs local contrast enhancement
 
         Loads the specified image, performs either NormalizeLocalContrast (default), CLAHE or no local contrast
@@ -358,13 +558,14 @@ class Stitcher:
                 the image)
             return_numpy_img (bool): Whether the function should return a numpy version of the image. Defaults to False
                 (not returning the image)
+            defer_eight_bit (bool): Whether the 8 bit conversion is skipped here because the caller converts the image
+                to 8 bit later (e.g. after stitching). Defaults to False (converting here if eight_bit is True)
 
         Returns:
             ImagePlus: The processed image as an ImageJ1 ImagePlus image (if return_image is True)
 
                 """
-        from jnius import autoclass
-        IJ = autoclass('ij.IJ')
+        IJ = _jclass('ij.IJ')
 
         if logger is None:
             logger = logging.getLogger()
@@ -373,7 +574,7 @@ class Stitcher:
 
         if use_norm_local_contrast:
             logger.debug('Loading {} and performing NormalizeLocalContrast on it'.format(str(img_path)))
-            NormLocalContrast = autoclass('mpicbg.ij.plugin.NormalizeLocalContrast')
+            NormLocalContrast = _jclass('mpicbg.ij.plugin.NormalizeLocalContrast')
             brx = kwargs.get('brx', 300)
             bry = kwargs.get('bry', 300)
             stds = kwargs.get('stds', 4)
@@ -384,7 +585,7 @@ class Stitcher:
 
         elif use_CLAHE:
             logger.debug('Loading {} and performing CLAHE on it'.format(str(img_path)))
-            Flat = autoclass('mpicbg.ij.clahe.Flat')
+            Flat = _jclass('mpicbg.ij.clahe.Flat')
             blockRadius = kwargs.get('blockRadius', 63)
             bins = kwargs.get('bins', 255)
             slope = kwargs.get('slope', 3)
@@ -396,7 +597,7 @@ class Stitcher:
         else:
             logger.debug('Loading {}. Not performing any contrast enhancements'.format(str(img_path)))
 
-        if eight_bit:
+        if eight_bit and not defer_eight_bit:
             IJ.run(image_plus_img, "8-bit", "")
         if save_img:
             IJ.saveAsTiff(image_plus_img, str(output_path))
@@ -411,6 +612,95 @@ class Stitcher:
             image_plus_img.close()
             return
 
+    @staticmethod
+    def joint_local_contrast_enhancement(img_paths, positions, logger=None, eight_bit: bool = True,
+                                         defer_eight_bit: bool = False, **kwargs):
+        """Loads the tiles of an annotation and performs NormalizeLocalContrast on them together with their neighbors
+
+        Instead of running NormalizeLocalContrast on every tile separately, each tile is placed on a canvas together
+        with the parts of its neighboring tiles that fall within the block radius around it. The neighbors are placed
+        at their starting positions for the stitching, thus with their overlap, such that the block statistics at the
+        tile borders are calculated on adjacent image content. The tile itself is placed on top of its neighbors, so
+        its own pixels are cut out unchanged (apart from the contrast enhancement) for the stitching.
+        This improves the consistency of the contrast at the seams, but costs more than enhancing each tile on its own
+        (as in local_contrast_enhancement): NormalizeLocalContrast still runs once per tile, on a canvas that is up to
+        about 1.3 times the tile area, and up to 9 tiles are inserted per canvas. A single pass on one canvas of all
+        tiles is not used, because the tiles overwrite each other's overlap there and the registration needs the
+        overlap pixels of both tiles.
+        The parameters for NormalizeLocalContrast have the same defaults as in local_contrast_enhancement and can be
+        overwritten using the **kwargs
+
+        Args:
+            img_paths (list): List of the full paths to the tiles to be processed (as strings)
+            positions (np.array): Starting positions of the tiles for the stitching, in the same order as img_paths
+            logger (Logging): Logging object that is configured for the logging either in multiprocessing or normal
+                processing. Defaults to None, thus loading the logger
+            eight_bit (bool): Whether the images should be converted to 8 bit. Defaults to True (converting to 8 bit)
+            defer_eight_bit (bool): Whether the 8 bit conversion is skipped here because the caller converts the image
+                to 8 bit later (e.g. after stitching). Defaults to False (converting here if eight_bit is True)
+
+        Returns:
+            list: The processed tiles as ImageJ1 ImagePlus images, in the same order as img_paths
+
+        """
+        IJ = _jclass('ij.IJ')
+        ImagePlus = _jclass('ij.ImagePlus')
+        NormLocalContrast = _jclass('mpicbg.ij.plugin.NormalizeLocalContrast')
+
+        if logger is None:
+            logger = logging.getLogger()
+
+        logger.debug('Loading {} and performing NormalizeLocalContrast on them jointly'.format(img_paths))
+        tile_processors = []
+        for img_path in img_paths:
+            image_plus_img = IJ.openImage(str(img_path))
+            tile_processors.append(image_plus_img.getProcessor())
+            image_plus_img.close()
+
+        brx = kwargs.get('brx', 300)
+        bry = kwargs.get('bry', 300)
+        stds = kwargs.get('stds', 4)
+        center = kwargs.get('cent', True)
+        stretch = kwargs.get('stret', True)
+
+        width = tile_processors[0].getWidth()
+        height = tile_processors[0].getHeight()
+        tile_origins = np.rint(positions).astype(int)
+        # The canvas of a tile is limited to the area covered by the tiles, such that it has no empty borders
+        covered_min = tile_origins.min(axis=0)
+        covered_max = tile_origins.max(axis=0) + [width, height]
+
+        enhanced_processors = []
+        for tile_index, tile_processor in enumerate(tile_processors):
+            canvas_min = np.maximum(tile_origins[tile_index] - [brx, bry], covered_min)
+            canvas_max = np.minimum(tile_origins[tile_index] + [width + brx, height + bry], covered_max)
+            canvas_width, canvas_height = (canvas_max - canvas_min).tolist()
+            canvas = tile_processor.createProcessor(canvas_width, canvas_height)
+            # Insert the neighbors first and the tile itself last, so that it overwrites their overlap
+            for neighbor_index in [i for i in range(len(tile_processors)) if i != tile_index] + [tile_index]:
+                neighbor_x, neighbor_y = (tile_origins[neighbor_index] - canvas_min).tolist()
+                if -width < neighbor_x < canvas_width and -height < neighbor_y < canvas_height:
+                    canvas.insert(tile_processors[neighbor_index], neighbor_x, neighbor_y)
+
+            NormLocalContrast.run(canvas, brx, bry, stds, center, stretch)
+
+            tile_x, tile_y = (tile_origins[tile_index] - canvas_min).tolist()
+            canvas.setRoi(tile_x, tile_y, width, height)
+            enhanced_processors.append(canvas.crop())
+
+        # Convert all tiles with the same display range, so that they are all scaled the same way
+        if eight_bit and not defer_eight_bit:
+            for enhanced_processor in enhanced_processors:
+                enhanced_processor.resetMinAndMax()
+            display_min = min(enhanced_processor.getMin() for enhanced_processor in enhanced_processors)
+            display_max = max(enhanced_processor.getMax() for enhanced_processor in enhanced_processors)
+            for i, enhanced_processor in enumerate(enhanced_processors):
+                enhanced_processor.setMinAndMax(display_min, display_max)
+                enhanced_processors[i] = enhanced_processor.convertToByte(True)
+
+        return [ImagePlus(os.path.basename(img_path), enhanced_processor)
+                for img_path, enhanced_processor in zip(img_paths, enhanced_processors)]
+
     def parse_create_csv_batches(self, batch_size: int, highmag_layer: str = 'highmag'):
         """Creates the batch csv files of annotation_tiles
 
@@ -472,7 +762,8 @@ class Stitcher:
         return [annotation_tiles, annotation_csvs]
 
     def stitch_batch(self, annotation_csv_path, stitch_threshold: int = 1000, eight_bit: bool = True,
-                     show_arrow: bool = True, enhance_contrast: bool = True, multiprocessing_logger: bool = False):
+                     show_arrow: bool = True, enhance_contrast: bool = True, multiprocessing_logger: bool = False,
+                     defer_eight_bit: bool = False, enhance_contrast_mode: str = 'tile'):
         """Submits the stitching of a batch, the writing of an updated csv file and the deletion of the old csv file
 
         Args:
@@ -487,6 +778,16 @@ class Stitcher:
                 Defaults to True (thus enhancing contrast in the images)
             multiprocessing_logger (bool): Whether a multiprocessing logger or a normal logger should be used. Defaults
                 to False, thus using a normal logger
+            defer_eight_bit (bool): Whether the 8bit conversion should be done once on the stitched image instead of on
+                each tile before stitching. Only has an effect if eight_bit is True. Defaults to False, thus converting
+                the tiles
+            enhance_contrast_mode (str): How the contrast enhancement is performed if enhance_contrast is True. 'tile'
+                (default) enhances each tile separately, 'joint' takes the neighboring tiles into account, which is
+                slower (see joint_local_contrast_enhancement)
+
+        Returns:
+            tuple: The name of the stitched csv file and a pd.DataFrame with its content, such that the batches can be
+                combined without reading the csv files again
 
         """
         # Check if a folder for the stitched forks already exists. If not, create that folder
@@ -497,14 +798,20 @@ class Stitcher:
         stitched_annotation_tiles = self.stitch_annotated_tiles(annotation_tiles=annotation_tiles_loaded, logger=logger,
                                                                 stitch_threshold=stitch_threshold,
                                                                 eight_bit=eight_bit, show_arrow=show_arrow,
-                                                                enhance_contrast=enhance_contrast)
+                                                                enhance_contrast=enhance_contrast,
+                                                                defer_eight_bit=defer_eight_bit,
+                                                                enhance_contrast_mode=enhance_contrast_mode)
         csv_stitched_path = Path(str(annotation_csv_path)[:-4] + '_stitched.csv')
 
-        sip.MapsXmlParser.save_annotation_tiles_to_csv(stitched_annotation_tiles, self.base_header, csv_stitched_path)
+        # The stitched csv is still written, such that finished batches are kept if the run is interrupted
+        stitched_df = sip.MapsXmlParser.annotation_tiles_to_dataframe(stitched_annotation_tiles, self.base_header)
+        stitched_df.to_csv(str(csv_stitched_path), index=False)
         os.remove(str(annotation_csv_path))
+        return csv_stitched_path.name, stitched_df
 
     def manage_batches(self, stitch_threshold: int = 1000, eight_bit: bool = True, show_arrow: bool = True,
-                       max_processes: int = 4, enhance_contrast: bool = True):
+                       max_processes: int = 4, enhance_contrast: bool = True, defer_eight_bit: bool = False,
+                       enhance_contrast_mode: str = 'tile'):
         """Manages the parallelization of the stitching of batches
 
         As multiprocessing can make some issues, if max_processes is set to 1, it does not use multiprocessing calls.
@@ -520,22 +827,50 @@ class Stitcher:
                 Be careful, each batch needs a lot of memory
             enhance_contrast (bool): Whether contrast enhancement should be performed on the images before stitching.
                 Defaults to True (thus enhancing contrast in the images)
+            defer_eight_bit (bool): Whether the 8bit conversion should be done once on the stitched image instead of on
+                each tile before stitching. Only has an effect if eight_bit is True. Defaults to False, thus converting
+                the tiles
+            enhance_contrast_mode (str): How the contrast enhancement is performed if enhance_contrast is True. 'tile'
+                (default) enhances each tile separately, 'joint' takes the neighboring tiles into account, which is
+                slower (see joint_local_contrast_enhancement)
+
+        Returns:
+            dict: The stitched batches with the name of the stitched csv file as key and a pd.DataFrame of its content
+                as value. Can be passed to combine_csvs to avoid reading the stitched csv files again
 
         """
-        # Populate annotation_csv_list by looking at csv files in directory
-        items = os.listdir(self.csv_base_path)
-        annotation_csv_list = []
-        regex = re.compile('_annotations_\d+\.csv')
-        for name in items:
-            if regex.search(name):
-                annotation_csv_list.append(self.csv_base_path / name)
+        # Populate annotation_csv_list by looking at csv files in directory. os.scandir provides the file type without
+        # an additional stat call per file
+        with os.scandir(str(self.csv_base_path)) as entries:
+            annotation_csv_list = [Path(entry.path) for entry in entries
+                                   if entry.name.endswith('.csv') and _ANNOTATION_CSV_REGEX.search(entry.name)
+                                   and entry.is_file(follow_symlinks=False)]
         # There is an issue with an ImageJ library that only occurs in non-multiprocessing.
         # Therefore, always use multiprocessing, even for 1 process.
         # if max_processes > 1:
+        # Only keep a limited number of batches queued at the pool at any time. Submitting everything at once grows the
+        # task queue with the number of batches. Failed batches are logged and don't stop the other batches
+        logger = sip.MapsXmlParser.create_logger(self.log_file_path)
+        task_slots = threading.BoundedSemaphore(max_processes * 2)
+        stitched_batches = {}
+
+        def collect_batch(result):
+            stitched_csv_name, stitched_df = result
+            stitched_batches[stitched_csv_name] = stitched_df
+            task_slots.release()
+
+        def log_failed_batch(exception):
+            logger.error('Stitching a batch failed: {}'.format(exception))
+            task_slots.release()
+
         with multiprocessing.Pool(processes=max_processes) as pool:
             for annotation_csv_path in annotation_csv_list:
+                task_slots.acquire()
                 pool.apply_async(self.stitch_batch, args=(annotation_csv_path, stitch_threshold, eight_bit,
-                                                          show_arrow, enhance_contrast, True, ))
+                                                          show_arrow, enhance_contrast, True, ),
+                                 kwds={'defer_eight_bit': defer_eight_bit,
+                                       'enhance_contrast_mode': enhance_contrast_mode},
+                                 callback=collect_batch, error_callback=log_failed_batch)
 
             pool.close()
             pool.join()
@@ -543,8 +878,9 @@ class Stitcher:
         #     for annotation_csv_path in annotation_csv_list:
         #         self.stitch_batch(annotation_csv_path, stitch_threshold, eight_bit, show_arrow,
         #                           enhance_contrast, False)
+        return stitched_batches
 
-    def combine_csvs(self, delete_batches: bool = False, to_excel: bool = True):
+    def combine_csvs(self, delete_batches: bool = False, to_excel: bool = True, stitched_batches: dict = None):
         """Combines batch csv output files into the final csv file and optionally an excel file
 
         Args:
@@ -552,33 +888,40 @@ class Stitcher:
                 csv file. Defaults to False (not deleting the batch csv files)
             to_excel (bool): Whether the csv file should also be saved as an excel file. Defaults to True (creating the
                 Excel file)
+            stitched_batches (dict): The stitched batches returned by manage_batches. Batches contained in it are not
+                read from their csv file again. Stitched csv files of earlier runs are still read from disk. Defaults to
+                None (reading all stitched csv files)
 
         """
         logger = sip.MapsXmlParser.create_logger(self.log_file_path)
 
-        items = os.listdir(self.csv_base_path)
-        stitched_csvs = []
-        for name in items:
-            if name.endswith('_stitched.csv'):
-                stitched_csvs.append(name)
-
-        stitched_csvs.sort()
-        annotation_tiles = {}
-        for csv in stitched_csvs:
-            current_tiles = sip.MapsXmlParser.load_annotations_from_csv(self.base_header, self.csv_base_path / csv)
-            for key in current_tiles:
-                annotation_tiles[key] = current_tiles[key]
+        # Keep the paths of all files in the folder, such that they don't need to be joined again for the deletion
+        with os.scandir(str(self.csv_base_path)) as entries:
+            items = {entry.name: entry.path for entry in entries if entry.is_file(follow_symlinks=False)}
+        stitched_csvs = sorted(name for name in items if name.endswith('_stitched.csv'))
+
+        if not stitched_csvs:
+            logger.warning('No stitched csv files found in {}. Nothing to combine'.format(self.csv_base_path))
+            return
+
+        # The batch csv files all have the same columns, so they can be combined as they are, without parsing them into
+        # the annotation_tiles dictionary and writing them again. If an annotation is in multiple batches, the last
+        # one is kept
+        if stitched_batches is None:
+            stitched_batches = {}
+        data_frame = pd.concat([stitched_batches[csv] if csv in stitched_batches else pd.read_csv(items[csv])
+                                for csv in stitched_csvs], ignore_index=True)
+        data_frame = data_frame.drop_duplicates(subset='Image', keep='last')
         csv_output_path = self.csv_base_path / (self.project_name + '_fused' + '.csv')
-        sip.MapsXmlParser.save_annotation_tiles_to_csv(annotation_tiles, self.base_header, csv_output_path)
+        data_frame.to_csv(str(csv_output_path), index=False)
 
         # Delete all the batch files if the option is set for it
         if delete_batches:
-            for name in items:
-                os.remove(self.csv_base_path / name)
+            for item_path in items.values():
+                os.remove(item_path)
 
         if to_excel:
             logger.info('Saving the annotations csv as an excel file')
-            data_frame = pd.read_csv(csv_output_path)
             excel_output_path = self.csv_base_path / (self.project_name + '_fused' + '.xlsx')
 
             # Create a list of headers whose column should be expanded to fit the content
@@ -588,9 +931,35 @@ class Stitcher:
                 if header in fitting_headers:
                     fitting_headers.remove(header)
 
-            no_wrap_text_style = Styler(wrap_text=False, shrink_to_fit=False)
-            excel_writer = StyleFrame.ExcelWriter(excel_output_path)
-            styled_df = StyleFrame(data_frame, styler_obj=no_wrap_text_style)
-            styled_df.to_excel(excel_writer, 'MapsAnnotations', index=False, columns_and_rows_to_freeze='A1',
-                               best_fit=fitting_headers)
-            excel_writer.save()
+            self._write_excel(data_frame, excel_output_path, fitting_headers)
+
+    @staticmethod
+    def _write_excel(data_frame, excel_output_path, fitting_headers, max_column_width: int = 60):
+        """Saves the annotations dataframe as a styled excel file
+
+        The widths of the fitting columns are calculated from the string lengths of their content in pandas and set
+        once per column, instead of letting StyleFrame fit them cell by cell.
+
+        Args:
+            data_frame (pd.DataFrame): The dataframe of all annotations
+            excel_output_path (Path): Path to where the excel file is saved
+            fitting_headers (list): List of the headers whose column should be expanded to fit the content
+            max_column_width (int): The maximal width of a fitted column. Defaults to 60
+
+        """
+        column_widths = {}
+        for header in fitting_headers:
+            content_lengths = data_frame[header].fillna('').astype(str).str.len()
+            content_width = int(content_lengths.max()) if len(content_lengths) > 0 else 0
+            column_widths[header] = min(max_column_width, max(len(str(header)), content_width)) + 2
+
+        no_wrap_text_style = Styler(wrap_text=False, shrink_to_fit=False)
+        excel_writer = StyleFrame.ExcelWriter(excel_output_path)
+        styled_df = StyleFrame(data_frame, styler_obj=no_wrap_text_style)
+        styled_df.to_excel(excel_writer, 'MapsAnnotations', index=False, columns_and_rows_to_freeze='A1')
+
+        worksheet = excel_writer.book['MapsAnnotations']
+        for column_index, header in enumerate(data_frame.columns):
+            if header in column_widths:
+                worksheet.column_dimensions[get_column_letter(column_index + 1)].width = column_widths[header]
+        excel_writer.save()